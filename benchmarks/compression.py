@@ -0,0 +1,165 @@
+"""Compare lambda distribution build time and size across compression presets.
+
+Usage: python benchmarks/compression.py [--bundle build/ldist-<name>] [--jobs N] [--json FILE]
+
+Without --bundle a synthetic bundle of Python sources, already compressed files,
+model weights and shared objects is generated. Before timing, the archives are
+checked to be byte for byte identical whether written serially or in parallel,
+and identical to ZipFile.write for entries that both deflate.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+import zipfile
+
+from lambda_setuptools.archive import (
+    CompressionPolicy,
+    archive_entries,
+    compress_entry,
+    write_archive,
+)
+
+
+def generate_bundle(root, seed=0):
+    rng = random.Random(seed)
+    words = [
+        "def",
+        "return",
+        "self",
+        "import",
+        "value",
+        "for",
+        "in",
+        "if",
+        "else",
+        "None",
+        "request",
+        "response",
+    ]
+    for package in range(20):
+        package_dir = os.path.join(root, f"package_{package}")
+        os.makedirs(package_dir)
+        for module in range(25):
+            with open(os.path.join(package_dir, f"module_{module}.py"), "w") as f:
+                for line in range(rng.randint(50, 400)):
+                    f.write(" ".join(rng.choice(words) for _ in range(8)) + "\n")
+        with open(os.path.join(package_dir, "_speedups.so"), "wb") as f:
+            # Code sections compress reasonably, so mix structure with noise
+            for _ in range(64):
+                f.write(bytes(rng.getrandbits(8) for _ in range(4096)))
+                f.write(b"\0" * 4096)
+    with open(os.path.join(root, "weights.bin"), "wb") as f:
+        f.write(os.urandom(16 * 1024 * 1024))
+    with gzip.open(os.path.join(root, "data.json.gz"), "wb") as f:
+        f.write(json.dumps([rng.random() for _ in range(500000)]).encode())
+
+
+def check_archive_bytes(entries, tmpdir, jobs):
+    """Fail unless the archive writer produces the same bytes on every path.
+
+    write_entry appends precompressed entries through private ZipFile
+    internals, so this catches a Python release that changes them.
+    """
+    jobs = max(jobs, 4)
+    for reproducible in (False, True):
+        for name, policy in (
+            ("none", None),
+            ("default", CompressionPolicy.from_preset("default")),
+        ):
+            serial = write_archive(
+                os.path.join(tmpdir, "serial.zip"), entries, 1, reproducible, policy
+            )
+            parallel = write_archive(
+                os.path.join(tmpdir, "parallel.zip"),
+                entries,
+                jobs,
+                reproducible,
+                policy,
+            )
+            if serial.sha256 != parallel.sha256:
+                raise AssertionError(
+                    f"{jobs} jobs wrote a different archive than 1 job "
+                    f"(policy {name}, reproducible {reproducible})"
+                )
+    # ZipFile.write deflates every entry, while the archive writer stores the
+    # entries that do not shrink, so compare on the ones both deflate
+    deflated = [
+        (path, arcname)
+        for path, arcname in entries
+        if compress_entry(path, arcname)[0].compress_type == zipfile.ZIP_DEFLATED
+    ]
+    reference_path = os.path.join(tmpdir, "reference.zip")
+    with zipfile.ZipFile(reference_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path, arcname in deflated:
+            zf.write(path, arcname)
+    with open(reference_path, "rb") as f:
+        reference_sha256 = hashlib.sha256(f.read()).hexdigest()
+    for check_jobs in (1, jobs):
+        result = write_archive(os.path.join(tmpdir, "check.zip"), deflated, check_jobs)
+        if result.sha256 != reference_sha256:
+            raise AssertionError(
+                f"{check_jobs} jobs wrote a different archive than ZipFile.write"
+            )
+    print(
+        f"{len(entries)} files archived identically serially, in parallel and by ZipFile.write"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bundle", help="a build directory to archive")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        bundle = args.bundle
+        if not bundle:
+            bundle = os.path.join(tmpdir, "bundle")
+            generate_bundle(bundle)
+        entries = archive_entries(bundle)
+        check_archive_bytes(entries, tmpdir, args.jobs)
+        unzipped = sum(os.path.getsize(path) for path, _ in entries)
+        policies = [("none", None)] + [
+            (preset, CompressionPolicy.from_preset(preset))
+            for preset in sorted(CompressionPolicy.PRESETS)
+        ]
+        results = []
+        for name, policy in policies:
+            started = time.perf_counter()
+            result = write_archive(
+                os.path.join(tmpdir, f"{name}.zip"), entries, args.jobs, True, policy
+            )
+            results.append(
+                dict(
+                    preset=name,
+                    seconds=time.perf_counter() - started,
+                    size=result.size,
+                    stored=sum(
+                        1
+                        for info in result.infolist
+                        if info.compress_type == zipfile.ZIP_STORED
+                    ),
+                )
+            )
+
+    print(f"{len(entries)} files, {unzipped} bytes unzipped, {args.jobs} jobs")
+    print(f"{'preset':<10} {'seconds':>8} {'bytes':>12} {'ratio':>6} {'stored':>6}")
+    for result in results:
+        print(
+            f"{result['preset']:<10} {result['seconds']:>8.3f} {result['size']:>12} "
+            f"{result['size'] / unzipped:>6.3f} {result['stored']:>6}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(files=len(entries), unzipped=unzipped, results=results), f)
+
+
+if __name__ == "__main__":
+    main()
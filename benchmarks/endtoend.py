@@ -0,0 +1,286 @@
+"""Time ldist, lupload and lupdate end to end on synthetic projects.
+
+Usage: python benchmarks/endtoend.py [--sizes small,medium,large] [--repeat N]
+    [--json FILE] [--baseline FILE] [--threshold 0.2]
+
+Each project's dependencies are generated as local wheels and installed with
+pip's index disabled, and uploads and updates go to the in-memory S3 and Lambda
+stand-in in benchmarks/stub.py, so no network access is needed. Every size is
+built cold (empty build directory and distribution cache) and then warm (the
+same build again). With --baseline, phases that got slower than a previous
+--json result by more than the threshold are reported and the exit status is 1.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from stub import start_stub
+
+SIZES = dict(
+    small=dict(modules=10, dependencies=3, dependency_modules=10, binary_size=0),
+    medium=dict(
+        modules=100,
+        dependencies=15,
+        dependency_modules=40,
+        binary_size=4 * 1024 * 1024,
+    ),
+    large=dict(
+        modules=500,
+        dependencies=40,
+        dependency_modules=100,
+        binary_size=32 * 1024 * 1024,
+    ),
+)
+# Timings below this are reported but never counted as regressions
+NOISE_SECONDS = 0.05
+
+
+def module_source(rng, imports=()):
+    lines = [f"import {name}" for name in imports]
+    for function in range(rng.randint(5, 30)):
+        lines.append(f"def function_{function}(value):")
+        for statement in range(rng.randint(2, 10)):
+            lines.append(f"    value = value * {rng.randint(1, 99)} + {statement}")
+        lines.append("    return value")
+    return "\n".join(lines) + "\n"
+
+
+def write_wheel(wheel_dir, name, files, requires):
+    """Write a pure py3 wheel of files, a dict of archive name to bytes."""
+    dist_info = f"{name}-1.0.0.dist-info"
+    files = dict(files)
+    files[f"{dist_info}/METADATA"] = "".join(
+        ["Metadata-Version: 2.1\n", f"Name: {name}\n", "Version: 1.0.0\n"]
+        + [f"Requires-Dist: {requirement}\n" for requirement in requires]
+    ).encode()
+    files[f"{dist_info}/WHEEL"] = (
+        b"Wheel-Version: 1.0\nGenerator: benchmark\nRoot-Is-Purelib: true\nTag: py3-none-any\n"
+    )
+    record = []
+    for arcname, data in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b"=")
+        record.append(f"{arcname},sha256={digest.decode()},{len(data)}\n")
+    record.append(f"{dist_info}/RECORD,,\n")
+    files[f"{dist_info}/RECORD"] = "".join(record).encode()
+    with zipfile.ZipFile(
+        os.path.join(wheel_dir, f"{name}-1.0.0-py3-none-any.whl"),
+        "w",
+        zipfile.ZIP_DEFLATED,
+    ) as zf:
+        for arcname, data in files.items():
+            zf.writestr(arcname, data)
+
+
+def generate_project(root, size, seed=0):
+    """Generate a project and the wheels it depends on, returning both directories.
+
+    Dependency i requires dependencies 2i+1 and 2i+2, so the project's single
+    direct requirement pulls in the whole tree. Every fourth dependency bundles
+    a shared object of random bytes, together totalling binary_size.
+    """
+    rng = random.Random(seed)
+    spec = SIZES[size]
+    wheel_dir = os.path.join(root, "wheels")
+    os.makedirs(wheel_dir)
+    count = spec["dependencies"]
+    binaries = list(range(0, count, 4))
+    for index in range(count):
+        package = f"benchdep{index}"
+        files = {f"{package}/__init__.py": b""}
+        for module in range(spec["dependency_modules"]):
+            files[f"{package}/module_{module}.py"] = module_source(rng).encode()
+        if index in binaries and spec["binary_size"]:
+            # Random.randbytes needs Python 3.9
+            size = spec["binary_size"] // len(binaries)
+            files[f"{package}/_native.so"] = rng.getrandbits(8 * size).to_bytes(
+                size, "little"
+            )
+        requires = [
+            f"benchdep{child}"
+            for child in (2 * index + 1, 2 * index + 2)
+            if child < count
+        ]
+        write_wheel(wheel_dir, package, files, requires)
+
+    project = os.path.join(root, "project")
+    package_dir = os.path.join(project, "benchapp")
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, "__init__.py"), "w") as f:
+        f.write("")
+    for module in range(spec["modules"]):
+        with open(os.path.join(package_dir, f"module_{module}.py"), "w") as f:
+            f.write(module_source(rng))
+    with open(os.path.join(package_dir, "handler.py"), "w") as f:
+        f.write(module_source(rng, ["benchdep0"]))
+        f.write("def handler(event, context):\n    return event\n")
+    with open(os.path.join(project, "setup.py"), "w") as f:
+        f.write(
+            "from setuptools import setup\n"
+            "setup(\n"
+            '    name="benchapp",\n'
+            '    version="1.0.0",\n'
+            '    packages=["benchapp"],\n'
+            '    install_requires=["benchdep0"],\n'
+            '    lambda_function="benchapp.handler:handler",\n'
+            ")\n"
+        )
+    return project, wheel_dir
+
+
+def run_build(project, wheel_dir, cache_dir, endpoint_url, function_name, timings_file):
+    env = dict(
+        os.environ,
+        PIP_NO_INDEX="1",
+        PIP_FIND_LINKS=wheel_dir,
+        XDG_CACHE_HOME=cache_dir,
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        AWS_DEFAULT_REGION="us-east-1",
+    )
+    command = [
+        sys.executable,
+        "setup.py",
+        "--quiet",
+        "ldist",
+        "lupload",
+        "--s3-bucket=benchmark",
+        f"--endpoint-url={endpoint_url}",
+        "lupdate",
+        f"--lambda-names={function_name}",
+        f"--endpoint-url={endpoint_url}",
+        f"--timings-file={timings_file}",
+    ]
+    started = time.perf_counter()
+    process = subprocess.run(
+        command,
+        cwd=project,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if process.returncode:
+        sys.stderr.write(process.stderr.decode("utf-8", "replace"))
+        process.check_returncode()
+    seconds = time.perf_counter() - started
+    with open(timings_file, "r") as tf:
+        timings = json.load(tf)
+    phases = {}
+    for record in timings["phases"]:
+        # Sum per target and per function phases, such as ldist.zip:<target>
+        name = record["name"].partition(":")[0]
+        phase = phases.setdefault(name, dict(seconds=0.0, bytes=0))
+        phase["seconds"] += record["seconds"]
+        phase["bytes"] += record["bytes"]
+    return dict(seconds=seconds, phases=phases)
+
+
+def best_of(runs):
+    """Combine repeated runs, keeping each phase's fastest time."""
+    phases = {}
+    for run in runs:
+        for name, phase in run["phases"].items():
+            if name not in phases or phase["seconds"] < phases[name]["seconds"]:
+                phases[name] = phase
+    return dict(seconds=min(run["seconds"] for run in runs), phases=phases)
+
+
+def benchmark(size, repeat, endpoint_url):
+    runs = dict(cold=[], warm=[])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        project, wheel_dir = generate_project(os.path.join(tmpdir, "source"), size)
+        for iteration in range(repeat):
+            cache_dir = os.path.join(tmpdir, f"cache-{iteration}")
+            for dirname in ("build", "dist"):
+                shutil.rmtree(os.path.join(project, dirname), ignore_errors=True)
+            for run in ("cold", "warm"):
+                runs[run].append(
+                    run_build(
+                        project,
+                        wheel_dir,
+                        cache_dir,
+                        endpoint_url,
+                        # A new function per iteration, so cold runs update its code
+                        f"benchmark-{size}-{iteration}",
+                        os.path.join(tmpdir, "timings.json"),
+                    )
+                )
+    return dict(
+        spec=SIZES[size], runs={run: best_of(results) for run, results in runs.items()}
+    )
+
+
+def compare(results, baseline, threshold):
+    """Return the (size, run, phase, baseline, current) rows that regressed."""
+    regressions = []
+    for size, result in results["sizes"].items():
+        for run, current in result["runs"].items():
+            previous = baseline["sizes"].get(size, {}).get("runs", {}).get(run)
+            if previous is None:
+                continue
+            rows = [("total", previous["seconds"], current["seconds"])] + [
+                (name, previous["phases"][name]["seconds"], phase["seconds"])
+                for name, phase in current["phases"].items()
+                if name in previous["phases"]
+            ]
+            for name, before, after in rows:
+                if after - before > max(before * threshold, NOISE_SECONDS):
+                    regressions.append((size, run, name, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="small,medium,large")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against a previous --json result")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    for size in sizes:
+        if size not in SIZES:
+            parser.error(f"unknown size {size}, expected one of {', '.join(SIZES)}")
+    server = start_stub()
+    endpoint_url = f"http://127.0.0.1:{server.server_port}"
+    results = dict(
+        python=sys.version.split()[0],
+        sizes={size: benchmark(size, args.repeat, endpoint_url) for size in sizes},
+    )
+    server.shutdown()
+
+    print(f"{'size':<8} {'run':<5} {'phase':<30} {'seconds':>8} {'bytes':>12}")
+    for size, result in results["sizes"].items():
+        for run, timing in result["runs"].items():
+            print(f"{size:<8} {run:<5} {'total':<30} {timing['seconds']:>8.3f}")
+            for name, phase in sorted(timing["phases"].items()):
+                print(
+                    f"{size:<8} {run:<5} {name:<30} {phase['seconds']:>8.3f} {phase['bytes']:>12}"
+                )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for size, run, name, before, after in regressions:
+            print(
+                f"regression: {size} {run} {name} {before:.3f}s -> {after:.3f}s "
+                f"(+{(after - before) / before if before else float('inf'):.0%})"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
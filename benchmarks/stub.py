@@ -0,0 +1,244 @@
+"""A minimal in-memory stand-in for the S3 and Lambda APIs used by lupload and lupdate.
+
+Usage: python benchmarks/stub.py [--port PORT]
+
+Only the calls lambda-setuptools makes are implemented, requests are not
+authenticated and functions are created on first use. Objects are kept in
+memory, so the stub is only suitable for benchmarks and local testing.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+ACCOUNT = "123456789012"
+REGION = "us-east-1"
+
+
+def decode_aws_chunked(body):
+    """Decode an aws-chunked body, dropping chunk signatures and trailing checksums."""
+    data = bytearray()
+    position = 0
+    while True:
+        line_end = body.index(b"\r\n", position)
+        size = int(body[position:line_end].split(b";")[0], 16)
+        position = line_end + 2
+        if not size:
+            return bytes(data)
+        data += body[position : position + size]
+        position += size + 2
+
+
+class StubState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.uploads = {}
+        self.functions = {}
+        self.layers = {}
+
+    def code(self, content):
+        data = self.objects[(content["S3Bucket"], content["S3Key"])]
+        return (
+            base64.b64encode(hashlib.sha256(data).digest()).decode("ascii"),
+            len(data),
+        )
+
+    def function(self, name):
+        name = name.rsplit(":", 1)[-1]
+        if name not in self.functions:
+            self.functions[name] = dict(
+                FunctionName=name,
+                FunctionArn=f"arn:aws:lambda:{REGION}:{ACCOUNT}:function:{name}",
+                CodeSha256="",
+                CodeSize=0,
+                Version="$LATEST",
+                Layers=[],
+                State="Active",
+                LastUpdateStatus="Successful",
+                Versions=0,
+            )
+        return self.functions[name]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_HEAD(self):
+        self._dispatch("HEAD")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if "aws-chunked" in self.headers.get("Content-Encoding", ""):
+            body = decode_aws_chunked(body)
+        state = self.server.state
+        with state.lock:
+            if url.path.startswith(("/2015-03-31/", "/2018-10-31/")):
+                self._lambda(method, unquote(url.path), body, state)
+            else:
+                self._s3(method, unquote(url.path), query, body, state)
+
+    def _send(self, status, body=b"", content_type="application/xml", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in headers:
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _json(self, status, document, error_type=None):
+        headers = [("x-amzn-ErrorType", error_type)] if error_type else []
+        self._send(status, json.dumps(document).encode(), "application/json", headers)
+
+    def _s3(self, method, path, query, body, state):
+        bucket, _, key = path.lstrip("/").partition("/")
+        etag = lambda data: f'"{hashlib.md5(data).hexdigest()}"'  # noqa: E731
+        if method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            state.uploads[upload_id] = {}
+            self._send(
+                200,
+                (
+                    f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                    f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>"
+                ).encode(),
+            )
+        elif method == "PUT" and "uploadId" in query:
+            state.uploads[query["uploadId"][0]][int(query["partNumber"][0])] = body
+            self._send(200, headers=[("ETag", etag(body))])
+        elif method == "POST" and "uploadId" in query:
+            parts = state.uploads.pop(query["uploadId"][0])
+            numbers = [
+                int(n) for n in re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)
+            ]
+            data = b"".join(parts[number] for number in numbers)
+            state.objects[(bucket, key)] = data
+            self._send(
+                200,
+                (
+                    f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{key}</Key>"
+                    f"<ETag>{etag(data)}</ETag></CompleteMultipartUploadResult>"
+                ).encode(),
+            )
+        elif method == "DELETE" and "uploadId" in query:
+            state.uploads.pop(query["uploadId"][0], None)
+            self._send(204)
+        elif method == "PUT":
+            state.objects[(bucket, key)] = body
+            self._send(200, headers=[("ETag", etag(body))])
+        elif method in ("GET", "HEAD") and (bucket, key) in state.objects:
+            data = state.objects[(bucket, key)]
+            self._send(200, data, "application/octet-stream", [("ETag", etag(data))])
+        else:
+            self._send(
+                404,
+                b"<Error><Code>NoSuchKey</Code><Message>Not Found</Message></Error>",
+            )
+
+    def _lambda(self, method, path, body, state):
+        request = json.loads(body) if body else {}
+        match = re.match(
+            r"^/2015-03-31/functions/([^/]+)(/code|/configuration|/versions)?$", path
+        )
+        if match:
+            function = state.function(match.group(1))
+            publish = method == "POST" and match.group(2) == "/versions"
+            if method == "PUT" and match.group(2) == "/code":
+                function["CodeSha256"], function["CodeSize"] = state.code(request)
+                publish = request.get("Publish", False)
+            elif method == "PUT" and match.group(2) == "/configuration":
+                function["Layers"] = [
+                    dict(Arn=arn) for arn in request.get("Layers", [])
+                ]
+            if publish:
+                function["Versions"] += 1
+                return self._json(
+                    201 if method == "POST" else 200,
+                    dict(function, Version=str(function["Versions"])),
+                )
+            if match.group(2):
+                return self._json(200, function)
+            return self._json(200, dict(Configuration=function))
+        match = re.match(r"^/2018-10-31/layers/([^/]+)/versions(?:/(\d+))?$", path)
+        if match:
+            name = match.group(1)
+            versions = state.layers.setdefault(name, [])
+            if method == "POST":
+                code_sha256, code_size = state.code(request["Content"])
+                version = len(versions) + 1
+                versions.append(
+                    dict(
+                        Version=version,
+                        LayerVersionArn=f"arn:aws:lambda:{REGION}:{ACCOUNT}:layer:{name}:{version}",
+                        Content=dict(CodeSha256=code_sha256, CodeSize=code_size),
+                        CompatibleRuntimes=request.get("CompatibleRuntimes", []),
+                    )
+                )
+                return self._json(201, versions[-1])
+            if match.group(2):
+                return self._json(200, versions[int(match.group(2)) - 1])
+            return self._json(
+                200,
+                dict(
+                    LayerVersions=[
+                        dict(Version=v["Version"], LayerVersionArn=v["LayerVersionArn"])
+                        for v in reversed(versions)
+                    ]
+                ),
+            )
+        self._json(
+            404, dict(Message=f"{path} is not implemented"), "ResourceNotFoundException"
+        )
+
+
+def start_stub(port=0):
+    """Start the stub in a background thread and return the server.
+
+    The endpoint URL is http://127.0.0.1:<server.server_port>.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.state = StubState()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    server = start_stub(args.port)
+    print(f"serving S3 and Lambda on http://127.0.0.1:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
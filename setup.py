@@ -40,11 +40,13 @@ setup(
             "ldist = lambda_setuptools.ldist:LDist",
             "lupload = lambda_setuptools.lupload:LUpload",
             "lupdate = lambda_setuptools.lupdate:LUpdate",
+            "lprofile = lambda_setuptools.lprofile:LProfile",
         ],
         "distutils.setup_keywords": [
             "lambda_function = lambda_setuptools.ldist:validate_lambda_function",
             "lambda_module = lambda_setuptools.ldist:add_lambda_module_to_py_modules",
             "lambda_package = lambda_setuptools.ldist:validate_lambda_package",
+            "lambda_targets = lambda_setuptools.ldist:validate_lambda_targets",
         ],
     },
 )
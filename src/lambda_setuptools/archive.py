@@ -0,0 +1,217 @@
+import hashlib
+import os
+import stat
+import time
+import zipfile
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+ArchiveResult = namedtuple("ArchiveResult", ["infolist", "size", "sha256"])
+
+# Formats that are already compressed, so deflating them only costs time
+STORED_EXTENSIONS = (
+    ".7z",
+    ".bz2",
+    ".gif",
+    ".gz",
+    ".jar",
+    ".jpeg",
+    ".jpg",
+    ".mp3",
+    ".mp4",
+    ".png",
+    ".tgz",
+    ".webp",
+    ".whl",
+    ".xz",
+    ".zip",
+    ".zst",
+)
+
+
+class CompressionPolicy:
+    """Decides how each archive entry is compressed.
+
+    Entries are stored when the level is 0, when their extension is in
+    store_extensions, or when deflating a sample of their first sample_size bytes
+    at level 1 leaves more than min_ratio of the sample. Entries that deflate to
+    no smaller than their original size are always stored.
+    """
+
+    PRESETS = {
+        "fastest": dict(level=1, min_ratio=0.8),
+        "default": dict(level=zlib.Z_DEFAULT_COMPRESSION, min_ratio=0.9),
+        "smallest": dict(level=9, min_ratio=0.98),
+    }
+
+    def __init__(
+        self,
+        level=zlib.Z_DEFAULT_COMPRESSION,
+        store_extensions=STORED_EXTENSIONS,
+        min_ratio=0.9,
+        sample_size=64 * 1024,
+    ):
+        self.level = level
+        self.store_extensions = tuple(store_extensions)
+        self.min_ratio = min_ratio
+        self.sample_size = sample_size
+
+    @classmethod
+    def from_preset(cls, preset, **kwargs):
+        options = dict(cls.PRESETS[preset])
+        options.update(kwargs)
+        return cls(**options)
+
+    def should_deflate(self, arcname, data):
+        if self.level == 0 or arcname.lower().endswith(self.store_extensions):
+            return False
+        if len(data) > self.sample_size:
+            sample = data[: self.sample_size]
+            return len(zlib.compress(sample, 1)) <= len(sample) * self.min_ratio
+        return True
+
+
+class HashingWriter:
+    """A write-only file wrapper that tracks the position and SHA-256 of the output."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._position = 0
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self._sha256.update(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
+def archive_entries(root):
+    """Return (path, arcname) pairs for every file below root, in os.walk order."""
+    entries = []
+    abs_root = os.path.abspath(root)
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            absname = os.path.abspath(os.path.join(dirpath, filename))
+            arcname = absname[len(abs_root) + 1 :].replace(os.sep, "/")
+            entries.append((absname, arcname))
+    return entries
+
+
+def entries_digest(entries):
+    """Return the SHA-256 of the arcnames and contents of entries, in any order."""
+    digest = hashlib.sha256()
+    for path, arcname in sorted(entries, key=lambda entry: entry[1]):
+        with open(path, "rb") as f:
+            file_digest = hashlib.sha256(f.read()).hexdigest()
+        digest.update(f"{arcname}\0{file_digest}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def reproducible_date_time():
+    """The timestamp given to every entry of a reproducible archive.
+
+    Honours SOURCE_DATE_EPOCH, clamped to the earliest time a zip file can hold.
+    """
+    epoch = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+    return max(time.gmtime(epoch)[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def compress_entry(path, arcname, date_time=None, policy=None):
+    """Read and compress one file, returning its ZipInfo and compressed data.
+
+    Without a date_time or policy this produces the same bytes as ZipFile.write,
+    except that entries which do not shrink are stored. With a date_time, the
+    entry gets that timestamp and normalized permissions so that the result only
+    depends on the file contents. zlib releases the GIL while deflating so
+    entries can be compressed concurrently in threads.
+    """
+    if date_time is None:
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    else:
+        zinfo = zipfile.ZipInfo(arcname, date_time)
+        zinfo.create_system = 3
+        mode = 0o755 if os.stat(path).st_mode & 0o111 else 0o644
+        zinfo.external_attr = (stat.S_IFREG | mode) << 16
+    if policy is None:
+        policy = CompressionPolicy(store_extensions=(), min_ratio=1)
+    with open(path, "rb") as f:
+        data = f.read()
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.compress_type = zipfile.ZIP_STORED
+    if policy.should_deflate(arcname, data):
+        compressor = zlib.compressobj(policy.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data):
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            data = deflated
+    zinfo.compress_size = len(data)
+    return zinfo, data
+
+
+def write_entry(zf, zinfo, data):
+    """Append an already compressed entry to an open ZipFile.
+
+    ZipFile has no public API for precompressed data, so this mirrors what
+    ZipFile.write does for a seekable file once the data is known.
+    """
+    zf._writecheck(zinfo)
+    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    zinfo.header_offset = zf.fp.tell()
+    zf.fp.write(zinfo.FileHeader(zip64))
+    zf.fp.write(data)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    zf.start_dir = zf.fp.tell()
+
+
+def write_archive(file, entries, jobs=1, reproducible=False, policy=None):
+    """Write entries into a new zip file, compressing with up to jobs threads.
+
+    file may be a path or a writable file object, which only needs write and
+    flush since the archive is written front to back without seeking. Entries
+    are always written in the order given (sorted by name when reproducible), so
+    the result does not depend on the number of jobs.
+    """
+    if hasattr(file, "write"):
+        return _write_archive(file, entries, jobs, reproducible, policy)
+    with open(file, "wb") as f:
+        return _write_archive(f, entries, jobs, reproducible, policy)
+
+
+def _write_archive(fileobj, entries, jobs, reproducible, policy):
+    date_time = None
+    if reproducible:
+        entries = sorted(entries, key=lambda entry: entry[1])
+        date_time = reproducible_date_time()
+    writer = HashingWriter(fileobj)
+    with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as zf:
+        if jobs <= 1:
+            for path, arcname in entries:
+                write_entry(zf, *compress_entry(path, arcname, date_time, policy))
+        else:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                # Bound the compressed data held in memory while keeping workers busy
+                pending = deque()
+                for path, arcname in entries:
+                    pending.append(
+                        executor.submit(
+                            compress_entry, path, arcname, date_time, policy
+                        )
+                    )
+                    if len(pending) >= jobs * 4:
+                        write_entry(zf, *pending.popleft().result())
+                while pending:
+                    write_entry(zf, *pending.popleft().result())
+    return ArchiveResult(zf.infolist(), writer.tell(), writer.hexdigest())
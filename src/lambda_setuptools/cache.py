@@ -0,0 +1,242 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import threading
+import time
+from distutils import log
+
+from pkg_resources import Requirement, parse_version
+
+
+def default_cache_dir():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "lambda-setuptools",
+    )
+
+
+def environment_tag():
+    # pip selects wheels for the interpreter and platform it runs under, so
+    # cached trees are only reusable by that same combination
+    return f"{sys.implementation.cache_tag}-{sysconfig.get_platform()}".replace(
+        ".", "_"
+    )
+
+
+def wheel_tag(dist_dir):
+    wheel_path = os.path.join(dist_dir, "WHEEL")
+    if not os.path.exists(wheel_path):
+        return "unknown"
+    with open(wheel_path, "r") as wf:
+        tags = [line.split(":", 1)[1].strip() for line in wf if line.startswith("Tag:")]
+    return ".".join(sorted(tags)) if tags else "unknown"
+
+
+def exact_pin(requirement):
+    """Return whether requirement allows exactly one version, as lockfile pins do."""
+    specs = list(requirement.specifier)
+    return (
+        not requirement.url
+        and len(specs) == 1
+        and specs[0].operator in ("==", "===")
+        and not specs[0].version.endswith(".*")
+    )
+
+
+def pip_selection(requirement):
+    """Return the (version, wheel tag) pip would install for requirement, or None.
+
+    pip resolves the requirement against the index and find-links without
+    installing anything, so the version is the one it would pick without the
+    cache. The tag is None when pip would build a source distribution. Needs
+    pip 22.2 or later, returning None with older versions.
+    """
+    requirement = Requirement.parse(str(requirement))
+    requirement.marker = None
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "pip",
+            "--disable-pip-version-check",
+            "install",
+            "--dry-run",
+            "--quiet",
+            "--no-deps",
+            "--ignore-installed",
+            "--report",
+            "-",
+            str(requirement),
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    try:
+        install = json.loads(process.stdout)["install"][0]
+        version = install["metadata"]["version"]
+    except (ValueError, KeyError, IndexError):
+        log.info(f"pip did not report a version for {requirement}: {process.stderr}")
+        return None
+    filename = install.get("download_info", {}).get("url", "").rsplit("/", 1)[-1]
+    if not filename.endswith(".whl"):
+        return version, None
+    # Expand compressed tag sets, like the Tag lines of the WHEEL file
+    python_tags, abi_tags, platform_tags = filename[:-4].split("-")[-3:]
+    tags = [
+        f"{python_tag}-{abi_tag}-{platform_tag}"
+        for python_tag in python_tags.split(".")
+        for abi_tag in abi_tags.split(".")
+        for platform_tag in platform_tags.split(".")
+    ]
+    return version, ".".join(sorted(tags))
+
+
+def tree_size(root):
+    size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def link_tree(src, dst):
+    """Hardlink every file under src into dst, copying when linking is not possible."""
+    for dirpath, _, filenames in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in filenames:
+            target = os.path.join(target_dir, filename)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(os.path.join(dirpath, filename), target)
+            except OSError:
+                shutil.copy2(os.path.join(dirpath, filename), target)
+
+
+class DistCache:
+    """A size bounded, least recently used cache of installed distribution trees.
+
+    Entries live at <cache_dir>/<environment tag>/<key>/<version>-<wheel tag>/ and
+    hold the unpacked tree along with an entry.json whose mtime records the last use.
+    Files are hardlinked out of the cache, so anything that later modifies the
+    build directory must replace files rather than write to them in place.
+    """
+
+    ENTRY_FILE = "entry.json"
+
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._root = os.path.join(cache_dir, environment_tag())
+        self._lock = threading.Lock()
+        os.makedirs(self._root, exist_ok=True)
+
+    def get(self, requirement, tag=None):
+        """Return the path to the newest cached tree satisfying requirement, or None.
+
+        With a tag, only entries unpacked from a wheel with that tag are used.
+
+        Like pip, prereleases only satisfy a requirement whose specifier names
+        one. Direct URL requirements are never served from the cache, since
+        entries are only keyed by name and version.
+        """
+        if requirement.url:
+            return None
+        key_dir = os.path.join(self._root, requirement.key)
+        if not os.path.isdir(key_dir):
+            return None
+        # Requirement.__contains__ always accepts prereleases
+        prereleases = bool(requirement.specifier.prereleases)
+        best = None
+        for name in os.listdir(key_dir):
+            entry = self._read_entry(os.path.join(key_dir, name))
+            if (
+                entry is None
+                or tag is not None
+                and entry["tag"] != tag
+                or not requirement.specifier.contains(
+                    entry["version"], prereleases=prereleases
+                )
+            ):
+                continue
+            if best is None or parse_version(entry["version"]) > parse_version(
+                best["version"]
+            ):
+                best = entry
+        if best is None:
+            return None
+        os.utime(os.path.join(best["path"], self.ENTRY_FILE))
+        log.info(f"using cached {requirement.key} {best['version']} ({best['tag']})")
+        return os.path.join(best["path"], "tree")
+
+    def put(self, dist, tree):
+        """Copy an installed tree for dist into the cache and return its cached path."""
+        dist_infos = [name for name in os.listdir(tree) if name.endswith(".dist-info")]
+        tag = wheel_tag(os.path.join(tree, dist_infos[0])) if dist_infos else "unknown"
+        entry_dir = os.path.join(self._root, dist.key, f"{dist.version}-{tag}")
+        if os.path.isdir(entry_dir):
+            return os.path.join(entry_dir, "tree")
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry_dir))
+        try:
+            shutil.copytree(tree, os.path.join(staging, "tree"))
+            with open(os.path.join(staging, self.ENTRY_FILE), "w") as ef:
+                json.dump(
+                    dict(
+                        key=dist.key,
+                        version=dist.version,
+                        tag=tag,
+                        size=tree_size(tree),
+                        created=time.time(),
+                    ),
+                    ef,
+                )
+            try:
+                os.rename(staging, entry_dir)
+            except OSError:
+                # Another build cached the same entry first
+                shutil.rmtree(staging)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        log.info(f"cached {dist.key} {dist.version} ({tag}) in {entry_dir}")
+        return os.path.join(entry_dir, "tree")
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        with self._lock:
+            entries = []
+            for key in os.listdir(self._root):
+                key_dir = os.path.join(self._root, key)
+                if not os.path.isdir(key_dir):
+                    continue
+                for name in os.listdir(key_dir):
+                    entry = self._read_entry(os.path.join(key_dir, name))
+                    if entry is not None:
+                        entries.append(entry)
+            total = sum(entry["size"] for entry in entries)
+            for entry in sorted(entries, key=lambda e: e["last_used"]):
+                if total <= self.max_size:
+                    break
+                log.info(
+                    f"evicting cached {entry['key']} {entry['version']} ({entry['tag']})"
+                )
+                shutil.rmtree(entry["path"], ignore_errors=True)
+                total -= entry["size"]
+
+    def _read_entry(self, entry_dir):
+        entry_file = os.path.join(entry_dir, self.ENTRY_FILE)
+        try:
+            with open(entry_file, "r") as ef:
+                entry = json.load(ef)
+            entry["last_used"] = os.path.getmtime(entry_file)
+        except (OSError, ValueError):
+            return None
+        entry["path"] = entry_dir
+        return entry
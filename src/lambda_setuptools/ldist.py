@@ -1,19 +1,96 @@
+import csv
 import errno
+import fnmatch
+import glob
+import hashlib
+import importlib.util
+import json
 import os
+import posixpath
 import re
 import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from distutils import log
 from distutils.errors import (
+    DistutilsExecError,
+    DistutilsFileError,
     DistutilsInternalError,
     DistutilsOptionError,
     DistutilsSetupError,
 )
 
 from lambda_pkg_resources import LAMBDA_EXCLUDES, DistInstaller, ExcludesWorkingSet
-from pkg_resources import WorkingSet, parse_requirements
+from pkg_resources import (
+    Requirement,
+    WorkingSet,
+    find_distributions,
+    parse_requirements,
+    safe_name,
+)
 from setuptools import Command
 
+from lambda_setuptools.archive import (
+    CompressionPolicy,
+    archive_entries,
+    compress_entry,
+    entries_digest,
+    write_archive,
+)
+from lambda_setuptools.cache import (
+    DistCache,
+    default_cache_dir,
+    environment_tag,
+    exact_pin,
+    link_tree,
+    pip_selection,
+    tree_size,
+)
+from lambda_setuptools.lockfile import read_lockfile, tree_hash, write_lockfile
+from lambda_setuptools.timing import command_timings
+from lambda_setuptools.treeshake import unreachable_files
+
+PRUNE_EXCLUDES = (
+    "tests/*",
+    "*/tests/*",
+    "__pycache__/*",
+    "*/__pycache__/*",
+    "docs/*",
+    "*/docs/*",
+    "*.pyi",
+    "*.dist-info/RECORD",
+)
+
+
+def finalize_boolean_option(command, option, default):
+    value = getattr(command, option)
+    if value is None or value == "":
+        value = default
+    elif value in ("True", "true", "Yes", "yes"):
+        value = True
+    elif value in ("False", "false", "No", "no"):
+        value = False
+    elif not isinstance(value, bool):
+        raise DistutilsOptionError(
+            f"{option.replace('_', '-')} must be True, true, Yes, yes, False, false, No, no or absent"
+        )
+    setattr(command, option, value)
+
+
+def finalize_integer_option(command, option, default):
+    value = getattr(command, option)
+    if value is None or value == "":
+        value = default
+    try:
+        value = int(value)
+    except ValueError:
+        raise DistutilsOptionError(f"{option.replace('_', '-')} must be an integer")
+    setattr(command, option, value)
+
 
 def validate_lambda_function(dist, attr, value):
     if not re.compile(r"^([a-zA-Z0-9_]+\.)*[a-zA-Z0-9_]+:[a-zA-Z0-9_]+$").match(value):
@@ -22,6 +99,51 @@ def validate_lambda_function(dist, attr, value):
         )
 
 
+def target_function_module(target):
+    """Return the name of the entry point module generated for a lambda target."""
+    return f"{target.replace('-', '_')}_function"
+
+
+def validate_lambda_targets(dist, attr, value):
+    if not isinstance(value, dict) or not value:
+        raise DistutilsSetupError(
+            f"{attr} must be a dict of target names to target definitions"
+        )
+    functions = set()
+    modules = {}
+    for target, definition in value.items():
+        if not re.compile(r"^[a-zA-Z_][a-zA-Z0-9_-]*$").match(target):
+            raise DistutilsSetupError(
+                f"{attr} target names must be letters, digits, '_' or '-', not {target!r}"
+            )
+        # '-' becomes '_' in the entry point module, which must be unique
+        module = target_function_module(target)
+        if module in modules:
+            raise DistutilsSetupError(
+                f"{attr} targets {modules[module]} and {target} both generate {module}"
+            )
+        modules[module] = target
+        if not isinstance(definition, dict) or "function" not in definition:
+            raise DistutilsSetupError(f"{attr} {target} must be a dict with a function")
+        unknown = set(definition) - {"function", "files", "functions"}
+        if unknown:
+            raise DistutilsSetupError(
+                f"{attr} {target} has unknown keys {', '.join(sorted(unknown))}"
+            )
+        validate_lambda_function(
+            dist, f"{attr} {target} function", definition["function"]
+        )
+        for path in definition.get("files", []):
+            if not os.path.isfile(path):
+                raise DistutilsSetupError(f"{attr} {target} file {path} doesn't exist")
+        for function in definition.get("functions", []):
+            if function in functions:
+                raise DistutilsSetupError(
+                    f"{attr} function {function} is listed by more than one target"
+                )
+            functions.add(function)
+
+
 def add_lambda_module_to_py_modules(dist, attr, value):
     py_modules = getattr(dist, "py_modules", None)
     if not py_modules:
@@ -59,6 +181,137 @@ class LDist(Command):
             None,
             'The directory to place the layer into. Defaults to "python" if not provided',
         ),
+        (
+            "incremental=",
+            None,
+            "Only rewrite changed files and reuse installed dependencies when the requirements are unchanged",
+        ),
+        (
+            "jobs=",
+            None,
+            "The number of threads used to compress the lambda distribution. Defaults to 1, 0 uses all CPUs",
+        ),
+        (
+            "reproducible=",
+            None,
+            "Sort entries and fix their timestamps and permissions in the lambda distribution. Defaults to True",
+        ),
+        (
+            "compression=",
+            None,
+            'The compression preset, "fastest", "default" or "smallest". Defaults to "default"',
+        ),
+        (
+            "compress-level=",
+            None,
+            "The deflate level from 0 (store only) to 9, overriding the compression preset",
+        ),
+        (
+            "store-extensions=",
+            None,
+            "Comma separated file extensions to store without compressing. Defaults to common compressed formats",
+        ),
+        (
+            "prune=",
+            None,
+            "Remove files matching prune-exclude from the lambda distribution. Defaults to False",
+        ),
+        (
+            "prune-exclude=",
+            None,
+            "Comma separated globs of build directory paths to prune. Defaults to tests, __pycache__, docs, type stubs and RECORD files",
+        ),
+        (
+            "prune-include=",
+            None,
+            "Comma separated globs of build directory paths to keep even if they match prune-exclude",
+        ),
+        (
+            "strip-binaries=",
+            None,
+            "Strip debug symbols from shared objects. Defaults to False",
+        ),
+        (
+            "strip-command=",
+            None,
+            'The strip executable used by strip-binaries. Defaults to "strip"',
+        ),
+        (
+            "max-size=",
+            None,
+            "Fail if the unzipped lambda distribution is larger than this many MB",
+        ),
+        (
+            "max-zipped-size=",
+            None,
+            "Fail if the zipped lambda distribution is larger than this many MB",
+        ),
+        (
+            "compile=",
+            None,
+            "Compile the lambda distribution to bytecode before zipping. Defaults to False",
+        ),
+        (
+            "compile-python=",
+            None,
+            "The interpreter to compile with, matching the lambda runtime. Defaults to the current interpreter",
+        ),
+        (
+            "optimize=",
+            None,
+            "The bytecode optimization level, 0, 1 or 2. Defaults to 0",
+        ),
+        (
+            "sourceless=",
+            None,
+            "Only ship bytecode, removing sources that compiled. Defaults to False",
+        ),
+        ("timings-file=", None, "Write the time spent in each phase to this JSON file"),
+        (
+            "use-cache=",
+            None,
+            "Install dependencies from the local distribution cache. Defaults to True",
+        ),
+        (
+            "cache-dir=",
+            None,
+            'The distribution cache directory. Defaults to "$XDG_CACHE_HOME/lambda-setuptools"',
+        ),
+        (
+            "cache-size=",
+            None,
+            "The maximum size of the distribution cache in MB. Defaults to 2048",
+        ),
+        (
+            "lockfile=",
+            None,
+            "Install the dependencies pinned in this lockfile, writing it from a full resolution if it does not exist",
+        ),
+        (
+            "update-lockfile=",
+            None,
+            "Resolve the dependencies and rewrite the lockfile even if it exists. Defaults to False",
+        ),
+        (
+            "install-workers=",
+            None,
+            "The number of dependencies to fetch and extract concurrently. Defaults to 8",
+        ),
+        (
+            "tree-shake=",
+            None,
+            "Remove modules the handler cannot import, found by static analysis. Defaults to False",
+        ),
+        (
+            "tree-shake-keep=",
+            None,
+            "Comma separated globs of build directory paths to keep when tree shaking, such as dynamically imported modules",
+        ),
+        (
+            "split-layer=",
+            None,
+            "Build third party dependencies into a layer and first party code into a thin function. Defaults to False",
+        ),
     ]
 
     def initialize_options(self):
@@ -68,6 +321,35 @@ class LDist(Command):
         setattr(self, "include_version", None)
         setattr(self, "build_layer", None)
         setattr(self, "layer_dir", None)
+        setattr(self, "incremental", None)
+        setattr(self, "jobs", None)
+        setattr(self, "reproducible", None)
+        setattr(self, "compression", None)
+        setattr(self, "compress_level", None)
+        setattr(self, "store_extensions", None)
+        setattr(self, "prune", None)
+        setattr(self, "prune_exclude", None)
+        setattr(self, "prune_include", None)
+        setattr(self, "strip_binaries", None)
+        setattr(self, "strip_command", None)
+        setattr(self, "max_size", None)
+        setattr(self, "max_zipped_size", None)
+        setattr(self, "compile", None)
+        setattr(self, "compile_python", None)
+        setattr(self, "optimize", None)
+        setattr(self, "sourceless", None)
+        setattr(self, "timings_file", None)
+        setattr(self, "use_cache", None)
+        setattr(self, "cache_dir", None)
+        setattr(self, "cache_size", None)
+        setattr(self, "lockfile", None)
+        setattr(self, "update_lockfile", None)
+        setattr(self, "install_workers", None)
+        setattr(self, "tree_shake", None)
+        setattr(self, "tree_shake_keep", None)
+        setattr(self, "split_layer", None)
+        # Not a user option, lupload sets this to stream the archive to S3
+        setattr(self, "archive_stream", None)
 
     def finalize_options(self):
         exclude_lambda_packages = getattr(self, "exclude_lambda_packages")
@@ -136,64 +418,349 @@ class LDist(Command):
         layer_dir = getattr(self, "layer_dir")
         if layer_dir is None:
             setattr(self, "layer_dir", "python")
-
-    def run(self):
-        # We must create a distribution to install first
-        # This is a short-cut to working with the actual build
-        # directory, or to using the 'install' command, which
-        # will generally only install a zipped egg
-        self.run_command("bdist_wheel")
-        bdist_wheel_command = self.get_finalized_command("bdist_wheel")
-        setattr(self, "_dist_dir", bdist_wheel_command.dist_dir)
-
-        # Install the package built by bdist_wheel
-        # (or bdist, or bdist_wheel, depending on how the user called setup.py
-        impl_tag, abi_tag, plat_tag = bdist_wheel_command.get_tag()
-        self._install_dist_package(
-            os.path.join(
-                bdist_wheel_command.dist_dir,
-                f"{bdist_wheel_command.wheel_dist_name}-{impl_tag}-{abi_tag}-{plat_tag}.whl",
+        finalize_boolean_option(self, "incremental", False)
+        finalize_integer_option(self, "jobs", 1)
+        if getattr(self, "jobs") < 1:
+            setattr(self, "jobs", os.cpu_count() or 1)
+        finalize_boolean_option(self, "reproducible", True)
+        if not getattr(self, "compression"):
+            setattr(self, "compression", "default")
+        if getattr(self, "compression") not in CompressionPolicy.PRESETS:
+            raise DistutilsOptionError(
+                "compression must be fastest, default, smallest or absent"
             )
+        compression_options = dict()
+        if getattr(self, "compress_level") not in (None, ""):
+            finalize_integer_option(self, "compress_level", None)
+            if not 0 <= getattr(self, "compress_level") <= 9:
+                raise DistutilsOptionError("compress-level must be between 0 and 9")
+            compression_options["level"] = getattr(self, "compress_level")
+        store_extensions = getattr(self, "store_extensions")
+        if store_extensions is not None:
+            compression_options["store_extensions"] = [
+                extension if extension.startswith(".") else f".{extension}"
+                for extension in store_extensions.lower().split(",")
+                if extension
+            ]
+        setattr(
+            self,
+            "_compression_policy",
+            CompressionPolicy.from_preset(
+                getattr(self, "compression"), **compression_options
+            ),
+        )
+        finalize_boolean_option(self, "prune", False)
+        prune_exclude = getattr(self, "prune_exclude")
+        setattr(
+            self,
+            "prune_exclude",
+            prune_exclude.split(",") if prune_exclude else list(PRUNE_EXCLUDES),
+        )
+        prune_include = getattr(self, "prune_include")
+        setattr(
+            self, "prune_include", prune_include.split(",") if prune_include else []
         )
+        finalize_boolean_option(self, "strip_binaries", False)
+        if not getattr(self, "strip_command"):
+            setattr(self, "strip_command", "strip")
+        finalize_integer_option(self, "max_size", 0)
+        finalize_integer_option(self, "max_zipped_size", 0)
+        finalize_boolean_option(self, "compile", False)
+        if not getattr(self, "compile_python"):
+            setattr(self, "compile_python", sys.executable)
+        finalize_integer_option(self, "optimize", 0)
+        if getattr(self, "optimize") not in (0, 1, 2):
+            raise DistutilsOptionError("optimize must be 0, 1 or 2")
+        finalize_boolean_option(self, "sourceless", False)
+        finalize_boolean_option(self, "use_cache", True)
+        if not getattr(self, "cache_dir"):
+            setattr(self, "cache_dir", default_cache_dir())
+        finalize_integer_option(self, "cache_size", 2048)
+        finalize_boolean_option(self, "update_lockfile", False)
+        if getattr(self, "update_lockfile") and not getattr(self, "lockfile"):
+            raise DistutilsOptionError("update-lockfile requires lockfile")
+        finalize_integer_option(self, "install_workers", 8)
+        if getattr(self, "install_workers") < 1:
+            raise DistutilsOptionError("install-workers must be at least 1")
+        finalize_boolean_option(self, "tree_shake", False)
+        if getattr(self, "tree_shake") and getattr(self, "build_layer"):
+            raise DistutilsOptionError("tree-shake cannot be used with build-layer")
+        if getattr(self.distribution, "lambda_targets", None) and getattr(
+            self, "build_layer"
+        ):
+            raise DistutilsOptionError("build-layer cannot be used with lambda_targets")
+        finalize_boolean_option(self, "split_layer", False)
+        if getattr(self, "split_layer") and getattr(self, "build_layer"):
+            raise DistutilsOptionError("split-layer cannot be used with build-layer")
+        tree_shake_keep = getattr(self, "tree_shake_keep")
+        setattr(
+            self,
+            "tree_shake_keep",
+            tree_shake_keep.split(",") if tree_shake_keep else [],
+        )
+
+    def run(self):
+        with command_timings(self) as timings:
+            setattr(self, "_timings", timings)
+            # We must create a distribution to install first
+            # This is a short-cut to working with the actual build
+            # directory, or to using the 'install' command, which
+            # will generally only install a zipped egg
+            with timings.phase("ldist.bdist_wheel") as phase:
+                self.run_command("bdist_wheel")
+                bdist_wheel_command = self.get_finalized_command("bdist_wheel")
+                setattr(self, "_dist_dir", bdist_wheel_command.dist_dir)
+                impl_tag, abi_tag, plat_tag = bdist_wheel_command.get_tag()
+                wheel_path = os.path.join(
+                    bdist_wheel_command.dist_dir,
+                    f"{bdist_wheel_command.wheel_dist_name}-{impl_tag}-{abi_tag}-{plat_tag}.whl",
+                )
+                phase["bytes"] = os.path.getsize(wheel_path)
+
+            # Install the package built by bdist_wheel
+            # (or bdist, or bdist_wheel, depending on how the user called setup.py
+            self._install_dist_package(wheel_path)
+
+            # Use zero (if none specified) or more of the lambda_function, lambda_module or
+            # lambda_package attributes to create the lambda entry point function
+            if not getattr(self, "build_layer"):
+                with timings.phase("ldist.entry_point"):
+                    self._create_lambda_entry_point()
+
+            if getattr(self, "incremental"):
+                self._remove_stale_files()
 
-        # Use zero (if none specified) or more of the lambda_function, lambda_module or
-        # lambda_package attributes to create the lambda entry point function
-        if not getattr(self, "build_layer"):
-            self._create_lambda_entry_point()
+            if getattr(self, "prune"):
+                with timings.phase("ldist.prune") as phase:
+                    phase["bytes"] = self._prune_lambda_package()
+            if getattr(self, "tree_shake"):
+                with timings.phase("ldist.tree_shake") as phase:
+                    phase["bytes"] = self._tree_shake()
+            if getattr(self, "strip_binaries"):
+                with timings.phase("ldist.strip") as phase:
+                    phase["bytes"] = self._strip_binaries()
 
-        # Now build the lambda package
-        self._build_lambda_package()
+            if getattr(self, "compile"):
+                with timings.phase("ldist.compile") as phase:
+                    self._compile_bytecode()
+                phase["bytes"] = tree_size(self._lambda_build_dir)
 
-    def _build_lambda_package(self):
-        dist_name = (
-            f"{self.distribution.get_name()}-{self.distribution.get_version()}.zip"
+            if getattr(self, "incremental"):
+                self._write_build_manifest()
+
+            self._check_size_budget()
+
+            # Now build the lambda package, or one for each target
+            with timings.phase("ldist.zip") as phase:
+                entries = archive_entries(self._lambda_build_dir)
+                layer_artifacts = []
+                if getattr(self, "split_layer"):
+                    entries, layer_entries = self._split_layer_entries(entries)
+                    layer_artifacts.append(self._build_layer_package(layer_entries))
+                if getattr(self.distribution, "lambda_targets", None):
+                    self._build_target_packages(entries)
+                else:
+                    self._build_lambda_package(entries)
+                setattr(self, "artifacts", layer_artifacts + getattr(self, "artifacts"))
+                phase["bytes"] = sum(
+                    artifact["dist_size"] for artifact in getattr(self, "artifacts")
+                )
+
+    def get_dist_name(self, target=None):
+        """Return the file name of the lambda distribution, or of a target's distribution."""
+        name = self.distribution.get_name()
+        if target:
+            name = f"{name}-{target}"
+        return (
+            f"{name}-{self.distribution.get_version()}.zip"
             if getattr(self, "include_version")
-            else f"{self.distribution.get_name()}.zip"
+            else f"{name}.zip"
+        )
+
+    def _build_lambda_package(self, entries):
+        artifact = self._build_archive(
+            self.get_dist_name(), entries, getattr(self, "archive_stream")
+        )
+        # Set the resulting distribution file path for downstream command use
+        setattr(self, "artifacts", [artifact])
+        setattr(self, "dist_name", artifact["dist_name"])
+        setattr(self, "dist_path", artifact["dist_path"])
+        setattr(self, "lambda_build_dir", self._lambda_build_dir)
+        setattr(self, "dist_sha256", artifact["dist_sha256"])
+        setattr(self, "dist_size", artifact["dist_size"])
+
+    def _build_target_packages(self, shared_entries):
+        targets = self.distribution.lambda_targets
+        modules = {target: target_function_module(target) for target in targets}
+
+        def build(target):
+            definition = targets[target]
+            # Leave out the other targets' entry point modules and their bytecode
+            others = tuple(
+                f"{module}." for other, module in modules.items() if other != target
+            )
+            files = {
+                os.path.basename(path): os.path.abspath(path)
+                for path in definition.get("files", [])
+            }
+            entries = [
+                (path, arcname)
+                for path, arcname in shared_entries
+                if arcname not in files
+                and not (
+                    arcname.rpartition("/")[0] in ("", "__pycache__")
+                    and arcname.rpartition("/")[2].startswith(others)
+                )
+            ] + [(path, arcname) for arcname, path in files.items()]
+            with self._timings.phase(f"ldist.zip:{target}") as phase:
+                artifact = self._build_archive(self.get_dist_name(target), entries)
+                phase["bytes"] = artifact["dist_size"]
+            artifact.update(
+                target=target, functions=list(definition.get("functions", []))
+            )
+            return artifact
+
+        log.info(
+            f"building {len(targets)} lambda targets from {self._lambda_build_dir}"
         )
+        with ThreadPoolExecutor(
+            max_workers=min(len(targets), os.cpu_count() or 1)
+        ) as executor:
+            artifacts = list(executor.map(build, sorted(targets)))
+        # Each target has its own dist, so only the list of them is set
+        setattr(self, "artifacts", artifacts)
+        setattr(self, "dist_name", None)
+        setattr(self, "dist_path", None)
+        setattr(self, "lambda_build_dir", self._lambda_build_dir)
+        setattr(self, "dist_sha256", None)
+        setattr(self, "dist_size", None)
+
+    def _split_layer_entries(self, entries):
+        # First party files, and the bytecode compiled from them, stay in the
+        # function. Everything else moves under layer_dir in the layer.
+        function_entries = []
+        layer_entries = []
+        for path, arcname in entries:
+            source = arcname
+            if arcname.endswith(".pyc"):
+                try:
+                    source = importlib.util.source_from_cache(arcname)
+                except ValueError:
+                    source = arcname[:-1]
+            if arcname in self._first_party_files or source in self._first_party_files:
+                function_entries.append((path, arcname))
+            else:
+                layer_entries.append((path, f"{getattr(self, 'layer_dir')}/{arcname}"))
+        return function_entries, layer_entries
+
+    def _build_layer_package(self, entries):
+        # The layer is named by a digest of its contents, so an unchanged
+        # dependency set reuses the zip built for it last time
+        digest = entries_digest(entries)
+        prefix = f"{self.distribution.get_name()}-layer-"
+        dist_name = f"{prefix}{digest[:16]}.zip"
         dist_path = os.path.join(self._dist_dir, dist_name)
+        for stale_path in glob.glob(os.path.join(self._dist_dir, f"{prefix}*.zip")):
+            if stale_path != dist_path:
+                log.info(f"removing {stale_path}")
+                os.remove(stale_path)
         if os.path.exists(dist_path):
-            os.remove(dist_path)
-        log.info(f"creating {dist_path}")
-        with zipfile.ZipFile(dist_path, "w", zipfile.ZIP_DEFLATED) as zf:
-            abs_src = os.path.abspath(self._lambda_build_dir)
-            for root, _, files in os.walk(self._lambda_build_dir):
-                for filename in files:
-                    absname = os.path.abspath(os.path.join(root, filename))
-                    arcname = absname[len(abs_src) + 1 :]
-                    log.debug(f"zipping {os.path.join(root, filename)} as {arcname}")
-                    zf.write(absname, arcname)
-        # Set the resulting distribution file path for downstream command use
-        setattr(self, "dist_name", dist_name)
-        setattr(self, "dist_path", dist_path)
+            log.info(f"layer contents are unchanged, reusing {dist_path}")
+            with open(dist_path, "rb") as df:
+                dist_sha256 = hashlib.sha256(df.read()).hexdigest()
+            artifact = dict(
+                target=None,
+                functions=[],
+                dist_name=dist_name,
+                dist_path=dist_path,
+                dist_sha256=dist_sha256,
+                dist_size=os.path.getsize(dist_path),
+            )
+            self._check_zipped_size(dist_name, artifact["dist_size"])
+        else:
+            with self._timings.phase("ldist.zip:layer") as phase:
+                artifact = self._build_archive(dist_name, entries)
+                phase["bytes"] = artifact["dist_size"]
+        artifact.update(layer=True)
+        log.info(
+            f"split {len(entries)} dependency files into {dist_name} "
+            f"({artifact['dist_size']} bytes)"
+        )
+        return artifact
+
+    def _build_archive(self, dist_name, entries, archive_stream=None):
+        if archive_stream is None:
+            dist_path = os.path.join(self._dist_dir, dist_name)
+            if os.path.exists(dist_path):
+                os.remove(dist_path)
+            log.info(f"creating {dist_path}")
+        else:
+            # The archive is written straight to the stream and never lands on disk
+            dist_path = None
+            log.info(f"streaming {dist_name}")
+        for path, arcname in entries:
+            log.debug(f"zipping {path} as {arcname}")
+        # Write through a temporary file so an interrupted build never leaves a
+        # partial zip under the final name
+        result = write_archive(
+            archive_stream or f"{dist_path}.ldist-tmp",
+            entries,
+            getattr(self, "jobs"),
+            getattr(self, "reproducible"),
+            self._compression_policy,
+        )
+        if dist_path:
+            os.replace(f"{dist_path}.ldist-tmp", dist_path)
+        log.info(f"{dist_name} is {result.size} bytes with SHA-256 {result.sha256}")
+        self._check_zipped_size(dist_name, result.size)
+        if getattr(self, "compile"):
+            bytecode_size = sum(
+                info.compress_size
+                for info in result.infolist
+                if info.filename in self._compiled_bytecode
+            )
+            log.info(
+                f"bytecode added {bytecode_size} bytes of compressed data to {dist_name}, "
+                f"removed sources saved {self._removed_source_size} bytes, a change of "
+                f"{bytecode_size - self._removed_source_size} bytes (not counting zip headers)"
+            )
+        return dict(
+            target=None,
+            functions=[],
+            layer=False,
+            dist_name=dist_name,
+            dist_path=dist_path,
+            dist_sha256=result.sha256,
+            dist_size=result.size,
+        )
+
+    def _check_zipped_size(self, dist_name, size):
+        max_zipped_size = getattr(self, "max_zipped_size") * 1024 * 1024
+        if max_zipped_size and size > max_zipped_size:
+            raise DistutilsExecError(
+                f"{dist_name} is {size} bytes, more than max-zipped-size of {max_zipped_size} bytes"
+            )
 
     def _create_lambda_entry_point(self):
         self._create_lambda_function()
         self._copy_lambda_package()
+        self._create_target_functions()
 
     def _create_lambda_function(self):
         lambda_function = getattr(self.distribution, "lambda_function", None)
         if not lambda_function:
             return
+        package_name = self.distribution.get_name().replace("-", "_").replace(".", "_")
+        self._write_function_module(f"{package_name}_function", lambda_function)
+
+    def _create_target_functions(self):
+        lambda_targets = getattr(self.distribution, "lambda_targets", None) or {}
+        for target, definition in lambda_targets.items():
+            self._write_function_module(
+                target_function_module(target), definition["function"]
+            )
+
+    def _write_function_module(self, module_name, lambda_function):
         components = lambda_function.split(":")
         module = components[0]
         function = components[1]
@@ -203,13 +770,9 @@ class LDist(Command):
             "\n",
             f"handler = {module}.{function}\n",
         ]
-        package_name = self.distribution.get_name().replace("-", "_").replace(".", "_")
-        function_path = os.path.join(
-            self._lambda_build_dir, f"{package_name}_function.py"
-        )
+        function_path = os.path.join(self._lambda_build_dir, f"{module_name}.py")
         log.info(f"creating {function_path}")
-        with open(function_path, "w") as py:
-            py.writelines(function_lines)
+        self._sync_file(function_path, "".join(function_lines).encode("utf-8"))
 
     def _copy_lambda_package(self):
         lambda_package = getattr(self.distribution, "lambda_package", None)
@@ -221,7 +784,201 @@ class LDist(Command):
                 log.debug(f"{filepath} is a directory, skipping lambda copy")
                 continue
             log.info(f"copying {filepath} to {self._lambda_build_dir}")
-            shutil.copy(filepath, self._lambda_build_dir)
+            with open(filepath, "rb") as lf:
+                self._sync_file(
+                    os.path.join(self._lambda_build_dir, filename), lf.read()
+                )
+
+    def _prune_lambda_package(self):
+        pruned_size = 0
+        for root, _, files in os.walk(self._lambda_build_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                relpath = os.path.relpath(path, self._lambda_build_dir).replace(
+                    os.sep, "/"
+                )
+                if not any(
+                    fnmatch.fnmatch(relpath, pattern)
+                    for pattern in getattr(self, "prune_exclude")
+                ) or any(
+                    fnmatch.fnmatch(relpath, pattern)
+                    for pattern in getattr(self, "prune_include")
+                ):
+                    continue
+                log.debug(f"pruning {path}")
+                pruned_size += os.path.getsize(path)
+                os.remove(path)
+        for root, _, _ in os.walk(self._lambda_build_dir, topdown=False):
+            self._remove_empty_dirs(root)
+        log.info(f"pruned {pruned_size} bytes from {self._lambda_build_dir}")
+        return pruned_size
+
+    def _tree_shake(self):
+        package_name = self.distribution.get_name().replace("-", "_").replace(".", "_")
+        roots = []
+        if getattr(self.distribution, "lambda_function", None):
+            roots.append(f"{package_name}_function")
+        if getattr(self.distribution, "lambda_module", None):
+            roots.append(self.distribution.lambda_module)
+        lambda_package = getattr(self.distribution, "lambda_package", None)
+        if lambda_package:
+            roots.extend(
+                filename[:-3]
+                for filename in os.listdir(lambda_package)
+                if filename.endswith(".py")
+            )
+        roots.extend(
+            target_function_module(target)
+            for target in getattr(self.distribution, "lambda_targets", None) or ()
+        )
+        if not roots:
+            raise DistutilsOptionError(
+                "tree-shake requires lambda_function, lambda_module, lambda_package or lambda_targets"
+            )
+        log.info(f"tree shaking {self._lambda_build_dir} from {', '.join(roots)}")
+        size = tree_size(self._lambda_build_dir)
+        sizes = {}
+        for relpath in unreachable_files(
+            self._lambda_build_dir, roots, getattr(self, "tree_shake_keep")
+        ):
+            path = os.path.join(self._lambda_build_dir, relpath)
+            log.debug(f"removing unreachable {path}")
+            package = relpath.split("/")[0]
+            sizes[package] = sizes.get(package, 0) + os.path.getsize(path)
+            os.remove(path)
+        for root, _, _ in os.walk(self._lambda_build_dir, topdown=False):
+            self._remove_empty_dirs(root)
+        shaken_size = sum(sizes.values())
+        log.info(
+            f"tree shaking removed {shaken_size} of {size} bytes from {self._lambda_build_dir}:"
+        )
+        for package, package_size in sorted(
+            sizes.items(), key=lambda item: item[1], reverse=True
+        ):
+            log.info(f"{package_size:>14}  {package}")
+        return shaken_size
+
+    def _strip_binaries(self):
+        stripped_size = 0
+        for root, _, files in os.walk(self._lambda_build_dir):
+            for filename in files:
+                if not (filename.endswith(".so") or ".so." in filename):
+                    continue
+                path = os.path.join(root, filename)
+                size = os.path.getsize(path)
+                # Strip into a new file so hardlinks into the cache are left intact
+                tmp_path = f"{path}.ldist-tmp"
+                try:
+                    subprocess.check_call(
+                        [
+                            getattr(self, "strip_command"),
+                            "--strip-debug",
+                            "-o",
+                            tmp_path,
+                            path,
+                        ]
+                    )
+                except OSError as exc:
+                    log.warn(f"unable to run {getattr(self, 'strip_command')}: {exc}")
+                    return stripped_size
+                except subprocess.CalledProcessError:
+                    log.warn(f"unable to strip {path}")
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    continue
+                shutil.copymode(path, tmp_path)
+                os.replace(tmp_path, path)
+                stripped_size += size - os.path.getsize(path)
+        log.info(f"stripped {stripped_size} bytes from shared objects")
+        return stripped_size
+
+    def _check_size_budget(self):
+        root = self._lambda_build_dir
+        if getattr(self, "build_layer"):
+            root = os.path.join(root, getattr(self, "layer_dir"))
+        sizes = {}
+        for dirpath, _, files in os.walk(self._lambda_build_dir):
+            for filename in files:
+                path = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(path, root).replace(os.sep, "/")
+                package = (
+                    relpath.split("/")[0] if "/" in relpath else "<top level files>"
+                )
+                sizes[package] = sizes.get(package, 0) + os.path.getsize(path)
+        size = sum(sizes.values())
+        if getattr(self, "prune") or getattr(self, "max_size"):
+            log.info(f"{self._lambda_build_dir} is {size} bytes:")
+            for package, package_size in sorted(
+                sizes.items(), key=lambda item: item[1], reverse=True
+            ):
+                log.info(f"{package_size:>14}  {package}")
+        max_size = getattr(self, "max_size") * 1024 * 1024
+        if max_size and size > max_size:
+            raise DistutilsExecError(
+                f"{self._lambda_build_dir} is {size} bytes, more than max-size of {max_size} bytes"
+            )
+
+    def _compile_bytecode(self):
+        # Lambda's filesystem is read only, so bytecode not shipped in the
+        # distribution is recompiled on every cold start. Hash based pycs stay
+        # valid despite the fixed timestamps of reproducible distributions.
+        size = tree_size(self._lambda_build_dir)
+        # Bytecode that was already there, such as pycs shipped in wheels, was
+        # not added by compiling. compileall replaces the pycs it writes.
+        existing = {
+            path: (stat.st_ino, stat.st_mtime_ns)
+            for path, stat in self._bytecode_stats()
+        }
+        command = [getattr(self, "compile_python")]
+        command.extend(["-O"] * getattr(self, "optimize"))
+        command.extend(
+            [
+                "-m",
+                "compileall",
+                "-q",
+                "-j",
+                str(getattr(self, "jobs")),
+                "--invalidation-mode",
+                "unchecked-hash",
+            ]
+        )
+        if getattr(self, "sourceless"):
+            # Sourceless imports need the legacy pyc location next to the source
+            command.append("-b")
+        command.append(self._lambda_build_dir)
+        log.info(f"compiling {self._lambda_build_dir} with {command[0]}")
+        if subprocess.call(command):
+            log.warn("some files could not be compiled and will be shipped as source")
+        self._removed_source_size = 0
+        if getattr(self, "sourceless"):
+            for root, dirs, files in os.walk(self._lambda_build_dir):
+                if "__pycache__" in dirs:
+                    dirs.remove("__pycache__")
+                    shutil.rmtree(os.path.join(root, "__pycache__"))
+                for filename in files:
+                    path = os.path.join(root, filename)
+                    if filename.endswith(".py") and os.path.exists(path + "c"):
+                        # The size the source would have taken in the archive
+                        self._removed_source_size += compress_entry(
+                            path, filename, policy=self._compression_policy
+                        )[0].compress_size
+                        os.remove(path)
+        self._compiled_bytecode = {
+            os.path.relpath(path, self._lambda_build_dir).replace(os.sep, "/")
+            for path, stat in self._bytecode_stats()
+            if existing.get(path) != (stat.st_ino, stat.st_mtime_ns)
+        }
+        log.info(
+            f"compiling changed the size of {self._lambda_build_dir} from {size} to "
+            f"{tree_size(self._lambda_build_dir)} bytes"
+        )
+
+    def _bytecode_stats(self):
+        for root, _, files in os.walk(self._lambda_build_dir):
+            for filename in files:
+                if filename.endswith(".pyc"):
+                    path = os.path.join(root, filename)
+                    yield path, os.stat(path)
 
     def _install_dist_package(self, wheel_path):
         # Get the name of the package that we just built
@@ -232,35 +989,399 @@ class LDist(Command):
         build_dir = self._lambda_build_dir
         if getattr(self, "build_layer"):
             build_dir = os.path.join(build_dir, getattr(self, "layer_dir"))
-        try:
-            if os.path.exists(self._lambda_build_dir):
-                shutil.rmtree(self._lambda_build_dir)
-            log.info(f"creating {self._lambda_build_dir}")
-            os.makedirs(build_dir)
-        except OSError as exc:
-            if exc.errno == errno.EEXIST and os.path.isdir(self._lambda_build_dir):
-                pass
+        self._build_manifest_path = self._lambda_build_dir + ".manifest.json"
+        with zipfile.ZipFile(wheel_path, "r") as zf:
+            requirements = self._wheel_requirements(zf)
+            lock = self._read_lockfile(requirements)
+            write_lock = getattr(self, "lockfile") and lock is None
+            manifest_requirements = self._manifest_requirements(requirements, lock)
+            manifest = (
+                self._read_build_manifest() if getattr(self, "incremental") else None
+            )
+            reuse_dependencies = (
+                manifest is not None
+                and manifest["requirements"] == manifest_requirements
+                and os.path.isdir(build_dir)
+                and not write_lock
+                # Tree shaking removes modules that changed code may now import
+                and not getattr(self, "tree_shake")
+            )
+            if reuse_dependencies:
+                log.info(f"updating {self._lambda_build_dir} incrementally")
+                self._previous_files = manifest["files"]
+                self._resolved = manifest["resolved"]
             else:
-                raise DistutilsInternalError(
-                    f"{self._lambda_build_dir} already exists and is not a directory"
+                self._previous_files = {}
+                try:
+                    if os.path.exists(self._lambda_build_dir):
+                        shutil.rmtree(self._lambda_build_dir)
+                    log.info(f"creating {self._lambda_build_dir}")
+                    os.makedirs(build_dir)
+                except OSError as exc:
+                    if exc.errno == errno.EEXIST and os.path.isdir(
+                        self._lambda_build_dir
+                    ):
+                        pass
+                    else:
+                        raise DistutilsInternalError(
+                            f"{self._lambda_build_dir} already exists and is not a directory"
+                        )
+            self._requirements = manifest_requirements
+            self._first_party_files = {}
+            log.info(
+                f"installing package {package_name} from {self._dist_dir} into {build_dir}"
+            )
+            # Extract our wheel into our build dir
+            with self._timings.phase("ldist.extract") as phase:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        self._sync_file(
+                            os.path.join(build_dir, info.filename), zf.read(info)
+                        )
+                        phase["bytes"] += info.file_size
+
+        if reuse_dependencies:
+            log.info("requirements are unchanged, skipping dependency resolution")
+            return
+
+        self._dist_cache = (
+            DistCache(
+                getattr(self, "cache_dir"), getattr(self, "cache_size") * 1024 * 1024
+            )
+            if getattr(self, "use_cache")
+            else None
+        )
+        self._link_lock = threading.Lock()
+        self._install_dir = build_dir
+        if lock is not None:
+            with self._timings.phase("ldist.install_locked") as phase:
+                resolved = self._install_locked(lock, build_dir)
+            phase["bytes"] = self._installed_size(resolved)
+        else:
+            with self._timings.phase("ldist.resolve") as phase:
+                self._prefetch_dependencies(build_dir)
+                # Everything is installed by now, so this only checks the set and
+                # replaces conflicting versions through the installer
+                resolved = self._working_set(build_dir).resolve(
+                    parse_requirements(package_name),
+                    installer=self._fetch_dist,
+                    replace_conflicting=True,
                 )
-        log.info(
-            f"installing package {package_name} from {self._dist_dir} into {build_dir}"
+            phase["bytes"] = self._installed_size(resolved)
+            if write_lock:
+                lock = self._write_lockfile(resolved, requirements)
+                self._requirements = self._manifest_requirements(requirements, lock)
+        self._resolved = sorted(
+            f"{dist.project_name}=={dist.version}" for dist in resolved
         )
-        # Extract our wheel into our build dir
-        with zipfile.ZipFile(wheel_path, "r") as zf:
-            zf.extractall(build_dir)
+        if self._dist_cache is not None:
+            self._dist_cache.evict()
+
+    def _installed_size(self, resolved):
+        # Sum the sizes recorded for the installed dependencies, which is far
+        # cheaper than walking the build directory inside the timed phase
+        package_key = safe_name(self.distribution.get_name()).lower()
+        size = 0
+        for dist in resolved:
+            if dist.key == package_key or not dist.has_metadata("RECORD"):
+                continue
+            for row in csv.reader(dist.get_metadata_lines("RECORD")):
+                if len(row) >= 3 and row[2].isdigit():
+                    size += int(row[2])
+        return size
 
+    def _working_set(self, build_dir):
         # Create the working set to get all recursive dependencies, EXCEPT for the libraries included
         # with the lambda environment
-        working_set = (
+        return (
             ExcludesWorkingSet(entries=[build_dir], excludes=LAMBDA_EXCLUDES)
             if getattr(self, "exclude_lambda_packages")
             else WorkingSet(entries=[build_dir])
         )
-        dist_installer = DistInstaller(build_dir)
-        working_set.resolve(
-            parse_requirements(package_name),
-            installer=dist_installer.fetch_dist,
+
+    def _read_lockfile(self, requirements):
+        lockfile = getattr(self, "lockfile")
+        if (
+            not lockfile
+            or getattr(self, "update_lockfile")
+            or not os.path.exists(lockfile)
+        ):
+            return None
+        try:
+            lock = read_lockfile(lockfile)
+        except (OSError, ValueError, KeyError) as err:
+            raise DistutilsFileError(f"unable to read {lockfile}: {err}")
+        if lock["requirements"] != requirements:
+            raise DistutilsExecError(
+                f"{lockfile} is out of date, rerun ldist with --update-lockfile=yes"
+            )
+        if lock["environment"] != environment_tag():
+            log.warn(
+                f"{lockfile} was written under {lock['environment']}, "
+                f"not {environment_tag()}, so its hashes may not match"
+            )
+        return lock
+
+    def _write_lockfile(self, resolved, requirements):
+        lockfile = getattr(self, "lockfile")
+        package_key = safe_name(self.distribution.get_name()).lower()
+        distributions = []
+        excluded = set()
+        for dist in resolved:
+            if getattr(self, "exclude_lambda_packages"):
+                excluded.update(
+                    requirement.key
+                    for requirement in dist.requires()
+                    if requirement.key in LAMBDA_EXCLUDES
+                )
+            if dist.key == package_key:
+                continue
+            digest = tree_hash(dist)
+            if digest is None:
+                raise DistutilsExecError(f"{dist} has no RECORD to hash for {lockfile}")
+            distributions.append((dist, digest))
+        lock = write_lockfile(lockfile, requirements, distributions, excluded)
+        log.info(f"wrote {len(distributions)} pinned distributions to {lockfile}")
+        return lock
+
+    def _manifest_requirements(self, requirements, lock):
+        # A changed lockfile changes the installed set even if the requirements do not
+        return (
+            requirements
+            + self._rewrite_options()
+            + [
+                f"{pin['name']}=={pin['version']} sha256={pin['sha256']}"
+                for pin in (lock["distributions"] if lock else [])
+            ]
+        )
+
+    def _rewrite_options(self):
+        # The options that delete or rewrite installed files in place. Reused
+        # dependencies keep the result, so changing them needs a clean install.
+        options = [f"prune={getattr(self, 'prune')}"]
+        if getattr(self, "prune"):
+            options.append(f"prune-exclude={','.join(getattr(self, 'prune_exclude'))}")
+            options.append(f"prune-include={','.join(getattr(self, 'prune_include'))}")
+        options.append(f"strip-binaries={getattr(self, 'strip_binaries')}")
+        if getattr(self, "strip_binaries"):
+            options.append(f"strip-command={getattr(self, 'strip_command')}")
+        options.append(f"compile={getattr(self, 'compile')}")
+        if getattr(self, "compile"):
+            options.append(f"compile-python={getattr(self, 'compile_python')}")
+            options.append(f"optimize={getattr(self, 'optimize')}")
+            options.append(f"sourceless={getattr(self, 'sourceless')}")
+        return options
+
+    def _install_locked(self, lock, build_dir):
+        lockfile = getattr(self, "lockfile")
+        log.info(
+            f"installing {len(lock['distributions'])} pinned distributions from {lockfile}"
+        )
+
+        def install(pin):
+            dist = self._fetch_dist(
+                Requirement.parse(f"{pin['name']}=={pin['version']}")
+            )
+            digest = tree_hash(dist)
+            if digest != pin["sha256"]:
+                raise DistutilsExecError(
+                    f"{pin['name']} {pin['version']} has tree hash {digest}, "
+                    f"but {lockfile} pins {pin['sha256']}"
+                )
+
+        with ThreadPoolExecutor(
+            max_workers=getattr(self, "install_workers")
+        ) as executor:
+            for _ in executor.map(install, lock["distributions"]):
+                pass
+
+        def unpinned(requirement):
+            raise DistutilsExecError(
+                f"{requirement} is required but not pinned in {lockfile}"
+            )
+
+        # Nothing new can be installed, so this only checks the pinned set is complete
+        return self._working_set(build_dir).resolve(
+            parse_requirements(self.distribution.get_name()),
+            installer=unpinned,
             replace_conflicting=True,
         )
+
+    def _prefetch_dependencies(self, build_dir):
+        """Fetch the dependency graph breadth-first, each level concurrently.
+
+        Only the first requirement seen for each project is fetched, as resolve
+        would. Conflicts are left for the resolve that follows.
+        """
+        package_key = safe_name(self.distribution.get_name()).lower()
+        excludes = (
+            LAMBDA_EXCLUDES if getattr(self, "exclude_lambda_packages") else set()
+        )
+        requirements = [
+            requirement
+            for dist in find_distributions(build_dir)
+            if dist.key == package_key
+            for requirement in dist.requires()
+        ]
+        seen = {package_key}
+        with ThreadPoolExecutor(
+            max_workers=getattr(self, "install_workers")
+        ) as executor:
+            while requirements:
+                fetching = []
+                for requirement in requirements:
+                    if requirement.key not in seen and requirement.key not in excludes:
+                        seen.add(requirement.key)
+                        fetching.append(requirement)
+                requirements = []
+                for requirement, dist in zip(
+                    fetching, executor.map(self._fetch_dist, fetching)
+                ):
+                    requirements.extend(dist.requires(requirement.extras))
+        log.info(
+            f"fetched {len(seen) - 1} distributions with {getattr(self, 'install_workers')} workers"
+        )
+
+    def _fetch_dist(self, requirement):
+        # Install a requirement through its own staging directory, or from the
+        # distribution cache, and link it into the build directory. Called
+        # concurrently, so linking and scanning the build directory both hold
+        # the link lock, and a scan never sees a half linked distribution.
+        tree = None
+        if self._dist_cache is not None and exact_pin(requirement):
+            tree = self._dist_cache.get(requirement)
+        elif self._dist_cache is not None and not requirement.url:
+            # Serving the newest cached version would pin every project on this
+            # machine to it, so pip picks the version before the cache is checked
+            selection = pip_selection(requirement)
+            if selection is not None:
+                version, tag = selection
+                tree = self._dist_cache.get(
+                    Requirement.parse(f"{requirement.project_name}=={version}"), tag
+                )
+        if tree is not None:
+            return self._link_dist(requirement, tree)
+        with tempfile.TemporaryDirectory(prefix="ldist-") as staging:
+            dist = DistInstaller(staging).fetch_dist(requirement)
+            # A tree built from a direct URL must not satisfy later
+            # requirements that only name the same version
+            if self._dist_cache is not None and not requirement.url:
+                tree = self._dist_cache.put(dist, staging)
+            return self._link_dist(requirement, tree or staging)
+
+    def _link_dist(self, requirement, tree):
+        with self._link_lock:
+            link_tree(tree, self._install_dir)
+            for dist in find_distributions(self._install_dir):
+                if dist in requirement:
+                    return dist
+        raise DistutilsInternalError(
+            f"{requirement} was not found in {self._install_dir} after installation"
+        )
+
+    def _wheel_requirements(self, zf):
+        # The inputs that decide the installed dependency set
+        requirements = [
+            f"exclude-lambda-packages={getattr(self, 'exclude_lambda_packages')}",
+            f"build-layer={getattr(self, 'build_layer')}",
+            f"layer-dir={getattr(self, 'layer_dir')}",
+        ]
+        for name in zf.namelist():
+            if name.endswith(".dist-info/METADATA") and name.count("/") == 1:
+                requirements.extend(
+                    sorted(
+                        line.strip()
+                        for line in zf.read(name).decode("utf-8").splitlines()
+                        if line.startswith("Requires-Dist:")
+                    )
+                )
+        return requirements
+
+    def _read_build_manifest(self):
+        try:
+            with open(self._build_manifest_path, "r") as mf:
+                return json.load(mf)
+        except (OSError, ValueError):
+            return None
+
+    def _remove_stale_files(self):
+        # Remove first party files, and the bytecode compiled from them, that
+        # were not produced by this build. Sourceless builds have already
+        # removed the sources, leaving only the recorded legacy pycs.
+        current = set(self._first_party_files)
+        for relpath in self._first_party_files:
+            current.update(self._bytecode_files(relpath))
+        for relpath in set(self._previous_files) - current:
+            path = os.path.join(self._lambda_build_dir, relpath)
+            if os.path.exists(path):
+                log.info(f"removing {path}")
+                os.remove(path)
+                self._remove_empty_dirs(os.path.dirname(path))
+
+    def _bytecode_files(self, relpath):
+        # The relative paths of the pycs compiled from a first party source
+        if not relpath.endswith(".py"):
+            return []
+        dirname, filename = posixpath.split(relpath)
+        pattern = os.path.join(
+            self._lambda_build_dir,
+            dirname,
+            "__pycache__",
+            f"{glob.escape(filename[:-3])}.*.pyc",
+        )
+        paths = [
+            os.path.relpath(path, self._lambda_build_dir).replace(os.sep, "/")
+            for path in glob.glob(pattern)
+        ]
+        if os.path.exists(os.path.join(self._lambda_build_dir, relpath + "c")):
+            paths.append(relpath + "c")
+        return paths
+
+    def _write_build_manifest(self):
+        # Record the bytecode compiled from first party files, so it is removed
+        # along with its source
+        for relpath in list(self._first_party_files):
+            for pyc_relpath in self._bytecode_files(relpath):
+                with open(os.path.join(self._lambda_build_dir, pyc_relpath), "rb") as f:
+                    self._first_party_files[pyc_relpath] = hashlib.sha256(
+                        f.read()
+                    ).hexdigest()
+        with open(self._build_manifest_path, "w") as mf:
+            json.dump(
+                dict(
+                    requirements=self._requirements,
+                    resolved=self._resolved,
+                    files=self._first_party_files,
+                ),
+                mf,
+                indent=2,
+                sort_keys=True,
+            )
+
+    def _remove_empty_dirs(self, path):
+        root = os.path.abspath(self._lambda_build_dir)
+        path = os.path.abspath(path)
+        while (
+            path != root
+            and path.startswith(root)
+            and os.path.isdir(path)
+            and not os.listdir(path)
+        ):
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+    def _sync_file(self, path, data):
+        # Write a first party file unless the previous build already wrote this
+        # content. Files are replaced rather than rewritten in place because the
+        # build directory may hold hardlinks into the distribution cache.
+        digest = hashlib.sha256(data).hexdigest()
+        relpath = os.path.relpath(path, self._lambda_build_dir).replace(os.sep, "/")
+        self._first_party_files[relpath] = digest
+        if self._previous_files.get(relpath) == digest and os.path.exists(path):
+            return
+        log.debug(f"writing {path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.ldist-tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
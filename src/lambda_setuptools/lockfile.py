@@ -0,0 +1,68 @@
+import csv
+import hashlib
+import json
+import os
+
+from lambda_setuptools.cache import environment_tag
+
+LOCKFILE_VERSION = 1
+
+
+def tree_hash(dist):
+    """Return the SHA-256 of the files listed in an installed distribution's RECORD.
+
+    Each file is hashed from disk rather than trusting the hashes in the RECORD,
+    so a modified or missing file changes the result. Returns None for
+    distributions without a RECORD.
+    """
+    if not dist.has_metadata("RECORD"):
+        return None
+    digest = hashlib.sha256()
+    paths = sorted(
+        row[0]
+        for row in csv.reader(dist.get_metadata_lines("RECORD"))
+        if row and not row[0].endswith(".dist-info/RECORD")
+    )
+    for path in paths:
+        file_path = os.path.join(dist.location, path)
+        if os.path.isfile(file_path):
+            with open(file_path, "rb") as f:
+                file_digest = hashlib.sha256(f.read()).hexdigest()
+        else:
+            file_digest = "missing"
+        digest.update(f"{path}\0{file_digest}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_lockfile(path):
+    with open(path, "r") as lf:
+        lock = json.load(lf)
+    if lock.get("version") != LOCKFILE_VERSION:
+        raise ValueError(f"unsupported lockfile version {lock.get('version')}")
+    return lock
+
+
+def write_lockfile(path, requirements, distributions, excluded):
+    """Write the resolved distribution set, pinned by version and tree hash.
+
+    distributions is a list of (distribution, tree hash) pairs and excluded the
+    requirements that were left out because the lambda runtime provides them.
+    Returns the lock as written.
+    """
+    lock = dict(
+        version=LOCKFILE_VERSION,
+        environment=environment_tag(),
+        requirements=requirements,
+        distributions=sorted(
+            (
+                dict(name=dist.project_name, version=dist.version, sha256=digest)
+                for dist, digest in distributions
+            ),
+            key=lambda pin: pin["name"].lower(),
+        ),
+        excluded=sorted(excluded),
+    )
+    with open(path, "w") as lf:
+        json.dump(lock, lf, indent=2)
+        lf.write("\n")
+    return lock
@@ -0,0 +1,222 @@
+import json
+import os
+import subprocess
+import sys
+from distutils import log
+from distutils.errors import DistutilsExecError, DistutilsOptionError
+
+from setuptools import Command
+
+from lambda_setuptools.ldist import finalize_integer_option
+
+# Run with -I -S, so sys.path starts out as just the standard library. Modules
+# loaded from anywhere other than the build directory, the runtime paths or the
+# standard library mean the handler found its way to the host's packages.
+IMPORT_SCRIPT = """\
+import os, sys
+paths = {paths!r}
+stdlib = [os.path.realpath(path) for path in sys.path]
+sys.path[:0] = paths
+import {module}
+
+def allowed(path):
+    path = os.path.realpath(path)
+    if any(path.startswith(os.path.realpath(p) + os.sep) for p in paths):
+        return True
+    # site-packages lives inside the standard library directory
+    return any(
+        path.startswith(p + os.sep)
+        and path[len(p) + 1 :].split(os.sep)[0] not in ("site-packages", "dist-packages")
+        for p in stdlib
+    )
+
+outside = sorted(
+    f"{{name}} ({{module.__file__}})"
+    for name, module in list(sys.modules.items())
+    if getattr(module, "__file__", None) and not allowed(module.__file__)
+)
+if outside:
+    sys.exit("imported from outside the build directory and runtime paths: " + ", ".join(outside))
+"""
+
+
+def parse_importtime(output):
+    """Parse -X importtime output into a tree of import nodes.
+
+    Returns the top level imports, each a dict with name, self_us, cumulative_us
+    and children. Imports are reported after their children, so each line adopts
+    the pending nodes one level deeper than itself.
+    """
+    pending = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|", 2)
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        node = dict(
+            name=name.strip(),
+            self_us=int(self_us),
+            cumulative_us=int(cumulative_us),
+            children=pending.pop(depth + 1, []),
+        )
+        pending.setdefault(depth, []).append(node)
+    return pending.get(0, [])
+
+
+class LProfile(Command):
+
+    description = "profile the cold start import time of the lambda distribution"
+    user_options = [
+        (
+            "python=",
+            None,
+            "The interpreter to profile with, matching the lambda runtime. Defaults to the current interpreter",
+        ),
+        (
+            "handler-module=",
+            None,
+            "The module to import. Defaults to the module generated for lambda_function, else lambda_module",
+        ),
+        ("top=", None, "The number of slowest imports to report. Defaults to 20"),
+        (
+            "runtime-path=",
+            None,
+            "Comma separated list of directories the lambda runtime provides, such as one holding boto3",
+        ),
+        ("json-file=", None, "Write the import tree to this file as JSON"),
+        (
+            "max-import-time=",
+            None,
+            "Fail if importing the handler module takes longer than this many milliseconds",
+        ),
+    ]
+
+    def initialize_options(self):
+        """Set default values for options."""
+        # Each user option must be listed here with their default value.
+        setattr(self, "python", None)
+        setattr(self, "handler_module", None)
+        setattr(self, "top", None)
+        setattr(self, "runtime_path", "")
+        setattr(self, "json_file", None)
+        setattr(self, "max_import_time", None)
+
+    def finalize_options(self):
+        if not getattr(self, "python"):
+            setattr(self, "python", sys.executable)
+        if not getattr(self, "handler_module"):
+            if getattr(self.distribution, "lambda_function", None):
+                package_name = (
+                    self.distribution.get_name().replace("-", "_").replace(".", "_")
+                )
+                setattr(self, "handler_module", f"{package_name}_function")
+            elif getattr(self.distribution, "lambda_module", None):
+                setattr(self, "handler_module", self.distribution.lambda_module)
+            else:
+                raise DistutilsOptionError(
+                    "handler-module is required without lambda_function or lambda_module"
+                )
+        setattr(
+            self,
+            "runtime_path",
+            [
+                os.path.abspath(path.strip())
+                for path in (getattr(self, "runtime_path") or "").split(",")
+                if path.strip()
+            ],
+        )
+        finalize_integer_option(self, "top", 20)
+        finalize_integer_option(self, "max_import_time", 0)
+
+    def run(self):
+        self.run_command("ldist")
+        ldist_cmd = self.get_finalized_command("ldist")
+        if getattr(ldist_cmd, "build_layer"):
+            raise DistutilsOptionError("lprofile cannot profile a layer")
+        build_dir = os.path.abspath(getattr(ldist_cmd, "lambda_build_dir"))
+        module = getattr(self, "handler_module")
+        # Isolated mode without the site module keeps every site-packages
+        # directory, .pth file, the environment and the working directory off
+        # sys.path. The build directory goes first, like /var/task
+        code = IMPORT_SCRIPT.format(
+            paths=[build_dir] + getattr(self, "runtime_path"), module=module
+        )
+        log.info(f"profiling import of {module} from {build_dir}")
+        process = subprocess.run(
+            [getattr(self, "python"), "-I", "-S", "-X", "importtime", "-c", code],
+            cwd=build_dir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if process.returncode:
+            raise DistutilsExecError(
+                f"importing {module} failed:\n{process.stderr[-4000:]}"
+            )
+        roots = [
+            root for root in parse_importtime(process.stderr) if root["name"] == module
+        ]
+        if not roots:
+            raise DistutilsExecError(f"no import time was reported for {module}")
+        root = roots[0]
+        slowest = self._slowest_imports(root)
+        self._log_tree(root, slowest)
+        if getattr(self, "json_file"):
+            with open(getattr(self, "json_file"), "w") as jf:
+                json.dump(
+                    dict(
+                        module=module,
+                        python=getattr(self, "python"),
+                        total_us=root["cumulative_us"],
+                        slowest=[
+                            dict(
+                                name=node["name"],
+                                self_us=node["self_us"],
+                                cumulative_us=node["cumulative_us"],
+                            )
+                            for node in slowest
+                        ],
+                        tree=root,
+                    ),
+                    jf,
+                    indent=2,
+                )
+            log.info(f"wrote import times to {getattr(self, 'json_file')}")
+        max_import_time = getattr(self, "max_import_time")
+        if max_import_time and root["cumulative_us"] > max_import_time * 1000:
+            raise DistutilsExecError(
+                f"importing {module} took {root['cumulative_us'] / 1000:.1f}ms, "
+                f"more than max-import-time of {max_import_time}ms"
+            )
+
+    def _slowest_imports(self, root):
+        nodes = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node["children"])
+        return sorted(nodes, key=lambda n: n["cumulative_us"], reverse=True)[
+            : getattr(self, "top")
+        ]
+
+    def _log_tree(self, root, slowest):
+        # Show the slowest imports along with the imports that pulled them in
+        slowest = {id(node) for node in slowest}
+        log.info(f"importing {root['name']} took {root['cumulative_us'] / 1000:.1f}ms")
+        log.info(f"{'cumulative':>12} {'self':>10}  module")
+
+        def log_node(node, depth):
+            if id(node) not in slowest:
+                return
+            log.info(
+                f"{node['cumulative_us'] / 1000:>10.1f}ms {node['self_us'] / 1000:>8.1f}ms  "
+                f"{'  ' * depth}{node['name']}"
+            )
+            for child in sorted(
+                node["children"], key=lambda n: n["cumulative_us"], reverse=True
+            ):
+                log_node(child, depth + 1)
+
+        log_node(root, 0)
@@ -1,14 +1,29 @@
+import base64
 import boto3
 import json
 import os
+import random
+import re
+import time
 
 from botocore.client import Config
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
 from distutils import log
-from distutils.errors import DistutilsArgError, DistutilsOptionError
+from distutils.errors import DistutilsArgError, DistutilsExecError, DistutilsOptionError
 from os import environ
 from setuptools import Command
 
+from lambda_setuptools.ldist import finalize_boolean_option, finalize_integer_option
+from lambda_setuptools.timing import command_timings
+
+
+RETRYABLE_ERRORS = (
+    'ResourceConflictException',
+    'ThrottlingException',
+    'TooManyRequestsException'
+)
+
 
 class LUpdate(Command):
     description = 'Update the specified Lambda functions or layers with the result of the lupload command'
@@ -16,7 +31,14 @@ class LUpdate(Command):
         ('function-names=', None, 'DEPRECATED - use "lambda-names" instead. Comma seperated list of function names to update. Must have at least one entry. Can be function names, partial ARNs, and/or full ARNs'),
         ('lambda-names=', None, 'Comma seperated list of function or layer names to update. Must have at least one entry. Can be function/layer names, partial ARNs, and/or full ARNs'),
         ('layer-runtimes=', None, 'Comma seperated list of python runtimes the layer is compatible with. Defaults to "python2.7,python3.6,python3.7"'),
-        ('region=', None, 'Region for the named lambda functions or layers. Defaults to AWS_DEFAULT_REGION if set, else "us-east-1"')
+        ('region=', None, 'Region for the named lambda functions or layers. Defaults to AWS_DEFAULT_REGION if set, else "us-east-1"'),
+        ('endpoint-url=', None, 'The endpoint for the Lambda API (optional)'),
+        ('max-workers=', None, 'The number of functions or layers to update concurrently. Defaults to 8'),
+        ('retries=', None, 'The number of times to retry an update that was throttled or conflicted with another update. Defaults to 5'),
+        ('wait=', None, 'Wait until each updated function\'s LastUpdateStatus is Successful. Defaults to False'),
+        ('skip-unchanged=', None, 'Skip functions and layers whose deployed CodeSha256 already matches the dist. Defaults to True'),
+        ('layer-name=', None, 'The name of the layer published for ldist --split-layer. Defaults to "<name>-dependencies"'),
+        ('timings-file=', None, 'Write the time spent in each phase to this JSON file')
     ]
 
     def initialize_options(self):
@@ -26,59 +48,245 @@ class LUpdate(Command):
         setattr(self, 'lambda_names', '')
         setattr(self, 'layer_runtimes', 'python2.7,python3.6,python3.7')
         setattr(self, 'region', environ.get('AWS_REGION', environ.get('AWS_DEFAULT_REGION', 'us-east-1')))
+        setattr(self, 'endpoint_url', '')
+        setattr(self, 'max_workers', None)
+        setattr(self, 'retries', None)
+        setattr(self, 'wait', None)
+        setattr(self, 'skip_unchanged', None)
+        setattr(self, 'layer_name', None)
+        setattr(self, 'timings_file', None)
 
     def finalize_options(self):
         """Post-process options."""
-        if not getattr(self, 'function_names') and not getattr(self, 'lambda_names'):
+        if getattr(self.distribution, 'lambda_targets', None):
+            # Each target lists the functions its dist is deployed to
+            if getattr(self, 'function_names') or getattr(self, 'lambda_names'):
+                raise DistutilsOptionError('lambda-names cannot be used with lambda_targets, list each target\'s functions instead')
+        elif not getattr(self, 'function_names') and not getattr(self, 'lambda_names'):
             raise DistutilsOptionError('lambda-names and/or function-names (DEPRECATED) is required')
         setattr(self, 'lambda_names', getattr(self, 'lambda_names') + ',' + getattr(self, 'function_names'))
         setattr(self, 'layer_runtimes', getattr(self, 'layer_runtimes').split(','))
+        finalize_integer_option(self, 'max_workers', 8)
+        if getattr(self, 'max_workers') < 1:
+            raise DistutilsOptionError('max-workers must be at least 1')
+        finalize_integer_option(self, 'retries', 5)
+        finalize_boolean_option(self, 'wait', False)
+        finalize_boolean_option(self, 'skip_unchanged', True)
+        if not getattr(self, 'layer_name'):
+            setattr(self, 'layer_name', re.sub(r'[^a-zA-Z0-9_-]', '-', self.distribution.get_name()) + '-dependencies')
 
     def run(self):
         """Run command."""
-        self.run_command('lupload')
-        ldist_cmd = self.get_finalized_command('ldist')
-        lupload_cmd = self.get_finalized_command('lupload')
-        s3_bucket = getattr(lupload_cmd, 's3_bucket')
-        s3_key = getattr(lupload_cmd, 's3_object_key')
-        s3_object_version = getattr(lupload_cmd, 's3_object_version')
-        # s3_object_version could be None if Versioning is not enabled in that
-        # bucket. That will be okay as it is optional to update_function_code.
-        if s3_bucket is None or s3_key is None:
-            raise DistutilsArgError('\'lupload\' missing attributes')
-        aws_lambda = boto3.client(
-            'lambda',
-            config=Config(signature_version='s3v4'),
-            region_name=getattr(self, 'region')
-        )
-        for lambda_name in set(getattr(self, 'lambda_names').split(',')):
-            if not lambda_name:
-                continue
-            if not getattr(ldist_cmd, 'build_layer', False):
+        with command_timings(self) as timings:
+            setattr(self, '_timings', timings)
+            self.run_command('lupload')
+            ldist_cmd = self.get_finalized_command('ldist')
+            lupload_cmd = self.get_finalized_command('lupload')
+            s3_bucket = getattr(lupload_cmd, 's3_bucket')
+            s3_objects = getattr(lupload_cmd, 's3_objects', None)
+            # An s3 object's version could be None if Versioning is not enabled in that
+            # bucket. That will be okay as it is optional to update_function_code.
+            if s3_bucket is None or not s3_objects:
+                raise DistutilsArgError('\'lupload\' missing attributes')
+            if len(getattr(self, 'endpoint_url')):
+                aws_lambda = boto3.client(
+                    'lambda',
+                    config=Config(signature_version='s3v4'),
+                    region_name=getattr(self, 'region'),
+                    endpoint_url=getattr(self, 'endpoint_url')
+                )
+            else:
+                aws_lambda = boto3.client(
+                    'lambda',
+                    config=Config(signature_version='s3v4'),
+                    region_name=getattr(self, 'region')
+                )
+            build_layer = getattr(ldist_cmd, 'build_layer', False)
+            results = []
+            layer_version_arn = None
+            layer_objects = [s3_object for s3_object in s3_objects if s3_object['layer']]
+            s3_objects = [s3_object for s3_object in s3_objects if not s3_object['layer']]
+            if layer_objects:
+                # The split layer must exist before the functions can reference it
                 try:
-                    log.info('Updating and publishing function {}'.format(lambda_name))
-                    kwargs = dict(
-                        FunctionName=lambda_name,
-                        S3Bucket=s3_bucket,
-                        S3Key=s3_key,
-                        Publish=True
+                    status, layer_version = self._ensure_layer_version(
+                        aws_lambda,
+                        getattr(self, 'layer_name'),
+                        s3_bucket,
+                        layer_objects[0]['key'],
+                        layer_objects[0]['version'],
+                        base64.b64encode(bytes.fromhex(layer_objects[0]['dist_sha256'])).decode('ascii')
                     )
-                    if s3_object_version:
-                        kwargs['S3ObjectVersion'] = s3_object_version
-                    aws_lambda.update_function_code(**kwargs)
-                except ClientError as err:
-                    log.warn('Error updating function {}\n{}'.format(lambda_name, err))
+                except (BotoCoreError, ClientError) as err:
+                    log.warn('Error publishing layer {}\n{}'.format(getattr(self, 'layer_name'), err))
+                    results.append((getattr(self, 'layer_name'), 'failed', str(err)))
+                else:
+                    layer_version_arn = layer_version['LayerVersionArn']
+                    results.append((getattr(self, 'layer_name'), status, 'version {}'.format(layer_version['Version'])))
+            if getattr(self.distribution, 'lambda_targets', None):
+                updates = sorted(
+                    ((lambda_name, s3_object) for s3_object in s3_objects for lambda_name in s3_object['functions']),
+                    key=lambda update: update[0]
+                )
             else:
+                updates = [
+                    (lambda_name, s3_objects[0])
+                    for lambda_name in sorted(set(name for name in getattr(self, 'lambda_names').split(',') if name))
+                ]
+
+            def update(lambda_name, s3_object):
+                if layer_objects and layer_version_arn is None:
+                    # The thin function code does not work without its dependencies
+                    return lambda_name, 'skipped', 'layer {} was not published'.format(getattr(self, 'layer_name'))
+                # Lambda reports CodeSha256 as the base64 encoded SHA-256 digest of the zip
+                code_sha256 = base64.b64encode(bytes.fromhex(s3_object['dist_sha256'])).decode('ascii')
                 try:
-                    log.info('Publishing layer {}'.format(lambda_name))
-                    content = dict(S3Bucket = s3_bucket, S3Key = s3_key)
-                    if s3_object_version:
-                        content['S3ObjectVersion'] = s3_object_version
-                    aws_lambda.publish_layer_version(
-                        LayerName=lambda_name,
-                        Description='{}-{}'.format(self.distribution.get_name(), self.distribution.get_version()),
-                        Content=content,
-                        CompatibleRuntimes=getattr(self, 'layer_runtimes')
+                    if not build_layer:
+                        return self._update_function(
+                            aws_lambda, lambda_name, s3_bucket, s3_object['key'], s3_object['version'], code_sha256,
+                            layer_version_arn
+                        )
+                    return self._publish_layer(
+                        aws_lambda, lambda_name, s3_bucket, s3_object['key'], s3_object['version'], code_sha256
                     )
-                except ClientError as err:
-                    log.warn('Error publishing layer {}\n{}'.format(lambda_name, err))
+                # Connection, timeout and waiter errors are BotoCoreErrors, and
+                # fail only this update rather than the whole run and its summary
+                except (BotoCoreError, ClientError) as err:
+                    log.warn('Error updating {}\n{}'.format(lambda_name, err))
+                    return lambda_name, 'failed', str(err)
+
+            with ThreadPoolExecutor(max_workers=getattr(self, 'max_workers')) as executor:
+                results.extend(executor.map(lambda args: update(*args), updates))
+            statuses = sorted(set(result[1] for result in results))
+            log.info('lupdate summary: {}'.format(', '.join(
+                '{} {}'.format(sum(1 for result in results if result[1] == status), status) for status in statuses
+            )))
+            for lambda_name, status, detail in results:
+                log.info('  {}: {} ({})'.format(lambda_name, status, detail))
+            failed = [result for result in results if result[1] == 'failed']
+            if failed:
+                raise DistutilsExecError('{} of {} updates failed: {}'.format(
+                    len(failed), len(results), ', '.join(result[0] for result in failed)
+                ))
+
+    def _update_function(self, aws_lambda, lambda_name, s3_bucket, s3_key, s3_object_version, code_sha256, layer_version_arn=None):
+        if getattr(self, 'skip_unchanged') or layer_version_arn:
+            with self._timings.phase('lupdate.get_function:{}'.format(lambda_name)):
+                configuration = self._call_with_backoff(aws_lambda.get_function, FunctionName=lambda_name)['Configuration']
+        layers_updated = layer_version_arn and self._update_function_layers(
+            aws_lambda, lambda_name, configuration, layer_version_arn
+        )
+        if getattr(self, 'skip_unchanged') and configuration['CodeSha256'] == code_sha256:
+            if layers_updated:
+                # Publish the new configuration like a code update would, so versions
+                # and the aliases pointing at them pick up the new layer too
+                with self._timings.phase('lupdate.wait:{}'.format(lambda_name)):
+                    aws_lambda.get_waiter('function_updated').wait(FunctionName=lambda_name)
+                log.info('Publishing function {}'.format(lambda_name))
+                with self._timings.phase('lupdate.publish_version:{}'.format(lambda_name)):
+                    response = self._call_with_backoff(
+                        aws_lambda.publish_version,
+                        FunctionName=lambda_name,
+                        CodeSha256=code_sha256
+                    )
+                return lambda_name, 'updated', 'version {} with layer {}'.format(response.get('Version'), layer_version_arn)
+            log.info('Function {} already has CodeSha256 {}, skipping'.format(lambda_name, code_sha256))
+            return lambda_name, 'unchanged', 'CodeSha256 {}'.format(code_sha256)
+        if layers_updated:
+            # The code can only be updated once the configuration update has finished
+            with self._timings.phase('lupdate.wait:{}'.format(lambda_name)):
+                aws_lambda.get_waiter('function_updated').wait(FunctionName=lambda_name)
+        log.info('Updating and publishing function {}'.format(lambda_name))
+        kwargs = dict(
+            FunctionName=lambda_name,
+            S3Bucket=s3_bucket,
+            S3Key=s3_key,
+            Publish=True
+        )
+        if s3_object_version:
+            kwargs['S3ObjectVersion'] = s3_object_version
+        with self._timings.phase('lupdate.update_function_code:{}'.format(lambda_name)):
+            response = self._call_with_backoff(aws_lambda.update_function_code, **kwargs)
+        if getattr(self, 'wait'):
+            log.info('Waiting for function {} to finish updating'.format(lambda_name))
+            with self._timings.phase('lupdate.wait:{}'.format(lambda_name)):
+                aws_lambda.get_waiter('function_updated').wait(FunctionName=lambda_name)
+        return lambda_name, 'updated', 'version {}'.format(response.get('Version'))
+
+    def _update_function_layers(self, aws_lambda, lambda_name, configuration, layer_version_arn):
+        # Replace any version of the layer the function already uses, keeping its other layers
+        layer_arn = layer_version_arn.rsplit(':', 1)[0]
+        layers = [layer['Arn'] for layer in configuration.get('Layers', [])]
+        updated_layers = [
+            layer_version_arn if layer.rsplit(':', 1)[0] == layer_arn else layer for layer in layers
+        ]
+        if layer_version_arn not in updated_layers:
+            updated_layers.append(layer_version_arn)
+        if updated_layers == layers:
+            return False
+        log.info('Updating function {} to use layer {}'.format(lambda_name, layer_version_arn))
+        with self._timings.phase('lupdate.update_function_configuration:{}'.format(lambda_name)):
+            self._call_with_backoff(
+                aws_lambda.update_function_configuration,
+                FunctionName=lambda_name,
+                Layers=updated_layers
+            )
+        return True
+
+    def _publish_layer(self, aws_lambda, lambda_name, s3_bucket, s3_key, s3_object_version, code_sha256):
+        status, layer_version = self._ensure_layer_version(
+            aws_lambda, lambda_name, s3_bucket, s3_key, s3_object_version, code_sha256
+        )
+        return lambda_name, status, 'version {}'.format(layer_version['Version'])
+
+    def _ensure_layer_version(self, aws_lambda, lambda_name, s3_bucket, s3_key, s3_object_version, code_sha256):
+        if getattr(self, 'skip_unchanged'):
+            layer_version = self._latest_layer_version(aws_lambda, lambda_name)
+            if layer_version is not None and layer_version['Content']['CodeSha256'] == code_sha256:
+                log.info('Layer {} version {} already has CodeSha256 {}, skipping'.format(
+                    lambda_name, layer_version['Version'], code_sha256
+                ))
+                return 'unchanged', layer_version
+        log.info('Publishing layer {}'.format(lambda_name))
+        content = dict(S3Bucket = s3_bucket, S3Key = s3_key)
+        if s3_object_version:
+            content['S3ObjectVersion'] = s3_object_version
+        with self._timings.phase('lupdate.publish_layer_version:{}'.format(lambda_name)):
+            response = self._call_with_backoff(
+                aws_lambda.publish_layer_version,
+                LayerName=lambda_name,
+                Description='{}-{}'.format(self.distribution.get_name(), self.distribution.get_version()),
+                Content=content,
+                CompatibleRuntimes=getattr(self, 'layer_runtimes')
+            )
+        return 'published', response
+
+    def _latest_layer_version(self, aws_lambda, layer_name):
+        with self._timings.phase('lupdate.get_layer_version:{}'.format(layer_name)):
+            layer_versions = self._call_with_backoff(
+                aws_lambda.list_layer_versions,
+                LayerName=layer_name,
+                MaxItems=1
+            )['LayerVersions']
+            if not layer_versions:
+                return None
+            # list_layer_versions omits the content, so fetch the latest version itself
+            return self._call_with_backoff(
+                aws_lambda.get_layer_version,
+                LayerName=layer_name,
+                VersionNumber=layer_versions[0]['Version']
+            )
+
+    def _call_with_backoff(self, method, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(**kwargs)
+            except ClientError as err:
+                if err.response['Error']['Code'] not in RETRYABLE_ERRORS or attempt >= getattr(self, 'retries'):
+                    raise
+                # Exponential backoff with full jitter, capped at 30 seconds
+                delay = random.uniform(0, min(30, 2 ** attempt))
+                attempt += 1
+                log.info('{} retrying in {:.1f}s (attempt {})'.format(err.response['Error']['Code'], delay, attempt))
+                time.sleep(delay)
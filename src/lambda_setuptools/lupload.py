@@ -3,11 +3,17 @@ import json
 import os
 
 from botocore.client import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from distutils import log
 from distutils.errors import DistutilsArgError, DistutilsOptionError
 from os import environ
 from setuptools import Command
 
+from lambda_setuptools.ldist import finalize_boolean_option, finalize_integer_option
+from lambda_setuptools.multipart import MIN_PART_SIZE, MultipartUpload, MultipartUploadWriter, upload_file
+from lambda_setuptools.timing import command_timings
+
 
 class LUpload(Command):
     description = 'upload the result of the ldist command to S3'
@@ -18,7 +24,14 @@ class LUpload(Command):
         ('kms-key-id=', None, 'The KMS key to use on upload (optional, but recommended)'),
         ('secret-access-key=', None, 'DEPRECATED - The secret access to use to upload'),
         ('s3-bucket=', None, 'The bucket to upload to'),
-        ('endpoint-url=', None, 'The endpoint for the referenced bucket (optional)')
+        ('endpoint-url=', None, 'The endpoint for the referenced bucket (optional)'),
+        ('content-addressed=', None, 'Key the dist by its SHA-256 and skip the upload if that key already exists. Defaults to False'),
+        ('multipart-threshold=', None, 'Dists of at least this many MB are uploaded with a multipart upload. Defaults to 16'),
+        ('part-size=', None, 'The multipart upload part size in MB. Defaults to 8, minimum 5'),
+        ('max-concurrency=', None, 'The number of uploads and multipart upload parts in flight at once. Defaults to 8'),
+        ('part-retries=', None, 'The number of times to retry a failed multipart upload part. Defaults to 3'),
+        ('stream=', None, 'Stream the dist to S3 while ldist zips it instead of writing it to disk first. Defaults to False'),
+        ('timings-file=', None, 'Write the time spent in each phase to this JSON file')
     ]
 
     def initialize_options(self):
@@ -30,6 +43,13 @@ class LUpload(Command):
         setattr(self, 'secret_access_key', os.environ.get('AWS_SECRET_ACCESS_KEY', None))
         setattr(self, 's3_bucket', None)
         setattr(self, 'endpoint_url', '')
+        setattr(self, 'content_addressed', None)
+        setattr(self, 'multipart_threshold', None)
+        setattr(self, 'part_size', None)
+        setattr(self, 'max_concurrency', None)
+        setattr(self, 'part_retries', None)
+        setattr(self, 'stream', None)
+        setattr(self, 'timings_file', None)
 
     def finalize_options(self):
         """Post-process options."""
@@ -39,51 +59,176 @@ class LUpload(Command):
         if getattr(self, 'access_key') and getattr(self, 'secret_access_key'):
             environ['AWS_ACCESS_KEY_ID'] = getattr(self, 'access_key')
             environ['AWS_SECRET_ACCESS_KEY'] = getattr(self, 'secret_access_key')
+        finalize_boolean_option(self, 'content_addressed', False)
+        finalize_integer_option(self, 'multipart_threshold', 16)
+        finalize_integer_option(self, 'part_size', 8)
+        if getattr(self, 'part_size') * 1024 * 1024 < MIN_PART_SIZE:
+            raise DistutilsOptionError('part-size must be at least 5')
+        finalize_integer_option(self, 'max_concurrency', 8)
+        if getattr(self, 'max_concurrency') < 1:
+            raise DistutilsOptionError('max-concurrency must be at least 1')
+        finalize_integer_option(self, 'part_retries', 3)
+        finalize_boolean_option(self, 'stream', False)
+        if getattr(self, 'stream') and getattr(self, 'content_addressed'):
+            # The SHA-256 is only known once the dist has been uploaded
+            raise DistutilsOptionError('stream cannot be used with content-addressed')
+        if getattr(self, 'stream') and getattr(self.distribution, 'lambda_targets', None):
+            raise DistutilsOptionError('stream cannot be used with lambda_targets')
 
     def run(self):
         """Run command."""
-        self.run_command('ldist')
-        ldist_cmd = self.get_finalized_command('ldist')
-        dist_path = getattr(ldist_cmd, 'dist_path')
-        dist_name = getattr(ldist_cmd, 'dist_name')
-        if dist_path is None or dist_name is None:
-            raise DistutilsArgError('\'ldist\' missing attributes')
+        with command_timings(self) as timings:
+            if getattr(self, 'stream'):
+                if not self.distribution.have_run.get('ldist'):
+                    self._stream_dist(timings)
+                    return
+                log.info('ldist has already run, uploading its dist instead of streaming')
+            self.run_command('ldist')
+            ldist_cmd = self.get_finalized_command('ldist')
+            artifacts = getattr(ldist_cmd, 'artifacts', None)
+            if not artifacts:
+                raise DistutilsArgError('\'ldist\' missing attributes')
+            s3 = self._s3_client()
+            # Split max-concurrency between the artifacts and their parts, so
+            # concurrent multipart uploads stay within the limit together
+            artifact_workers = min(getattr(self, 'max_concurrency'), len(artifacts))
+            setattr(self, '_part_concurrency', max(1, getattr(self, 'max_concurrency') // artifact_workers))
+            with ThreadPoolExecutor(max_workers=artifact_workers) as executor:
+                s3_objects = list(executor.map(
+                    lambda artifact: self._upload_artifact(s3, artifact, timings),
+                    artifacts
+                ))
+            self._set_s3_objects(s3_objects)
+
+    def _upload_artifact(self, s3, artifact, timings):
+        dist_path = artifact['dist_path']
+        dist_name = artifact['dist_name']
+        # Targets upload concurrently, so their phases are told apart by name
+        suffix = ':{}'.format(artifact['target']) if artifact['target'] else ''
+        if getattr(self, 'content_addressed'):
+            # ldist builds reproducible dists, so identical sources map to the same key
+            dist_name = '{}/{}'.format(artifact['dist_sha256'], dist_name)
         dist_name = getattr(self, 's3_prefix') + dist_name
+        self._log_upload(dist_name)
+        # Split layers are named by a digest of their contents, so they are content addressed too
+        if getattr(self, 'content_addressed') or artifact['layer']:
+            try:
+                with timings.phase('lupload.head' + suffix):
+                    response = s3.head_object(Bucket=getattr(self, 's3_bucket'), Key=dist_name)
+            except ClientError as err:
+                # Without s3:ListBucket, S3 answers 403 rather than 404 for a missing key
+                if err.response['Error']['Code'] in ('403', 'Forbidden', 'AccessDenied'):
+                    log.warn('Unable to check whether {} exists in {} ({}), uploading it. Allow s3:GetObject and s3:ListBucket to skip existing uploads'.format(
+                        dist_name, getattr(self, 's3_bucket'), err.response['Error']['Code']
+                    ))
+                elif err.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise
+            else:
+                log.info('{} already exists in {}, skipping upload'.format(dist_name, getattr(self, 's3_bucket')))
+                return self._s3_object(artifact, dist_name, response)
+        encryption = self._encryption()
+        with timings.phase('lupload.upload' + suffix) as phase:
+            phase['bytes'] = os.path.getsize(dist_path)
+            if phase['bytes'] >= getattr(self, 'multipart_threshold') * 1024 * 1024:
+                response = upload_file(
+                    s3,
+                    dist_path,
+                    getattr(self, 's3_bucket'),
+                    dist_name,
+                    getattr(self, 'part_size') * 1024 * 1024,
+                    max_concurrency=getattr(self, '_part_concurrency'),
+                    retries=getattr(self, 'part_retries'),
+                    **encryption
+                )
+            else:
+                with open(dist_path, 'rb') as dist:
+                    response = s3.put_object(
+                        Body=dist,
+                        Bucket=getattr(self, 's3_bucket'),
+                        Key=dist_name,
+                        **encryption
+                    )
+        self._uploaded(dist_name, response, phase)
+        return self._s3_object(artifact, dist_name, response)
+
+    def _stream_dist(self, timings):
+        ldist_cmd = self.get_finalized_command('ldist')
+        if getattr(ldist_cmd, 'split_layer'):
+            raise DistutilsOptionError('stream cannot be used with split-layer')
+        dist_name = getattr(self, 's3_prefix') + ldist_cmd.get_dist_name()
+        s3 = self._s3_client()
+        self._log_upload(dist_name)
+        with timings.phase('lupload.stream') as phase:
+            upload = MultipartUpload(
+                s3,
+                getattr(self, 's3_bucket'),
+                dist_name,
+                max_concurrency=getattr(self, 'max_concurrency'),
+                retries=getattr(self, 'part_retries'),
+                **self._encryption()
+            )
+            writer = MultipartUploadWriter(upload, getattr(self, 'part_size') * 1024 * 1024)
+            setattr(ldist_cmd, 'archive_stream', writer)
+            try:
+                self.run_command('ldist')
+            except BaseException:
+                writer.abort()
+                raise
+            finally:
+                setattr(ldist_cmd, 'archive_stream', None)
+            # Parts are sent while ldist zips, so only the last one is left to wait for
+            response = writer.close()
+            phase['bytes'] = getattr(ldist_cmd, 'dist_size')
+        self._uploaded(dist_name, response, phase)
+        self._set_s3_objects([self._s3_object(getattr(ldist_cmd, 'artifacts')[0], dist_name, response)])
+
+    def _s3_object(self, artifact, key, response):
+        return dict(
+            target=artifact['target'],
+            functions=artifact['functions'],
+            layer=artifact['layer'],
+            dist_sha256=artifact['dist_sha256'],
+            key=key,
+            version=response.get('VersionId')
+        )
+
+    def _set_s3_objects(self, s3_objects):
+        setattr(self, 's3_objects', s3_objects)
+        # The single object attributes are kept for builds without lambda_targets,
+        # and point at the function's dist even when a split layer was uploaded too
+        function_objects = [s3_object for s3_object in s3_objects if not s3_object['layer']]
+        setattr(self, 's3_object_key', function_objects[0]['key'] if len(function_objects) == 1 else None)
+        setattr(self, 's3_object_version', function_objects[0]['version'] if len(function_objects) == 1 else None)
+
+    def _s3_client(self):
         if len(getattr(self, 'endpoint_url')):
-            s3 = boto3.client(
+            return boto3.client(
                 's3',
                 config=Config(signature_version='s3v4'),
                 endpoint_url=getattr(self, 'endpoint_url')
             )
-        else:
-            s3 = boto3.client(
-                's3',
-                config=Config(signature_version='s3v4')
-            )
+        return boto3.client(
+            's3',
+            config=Config(signature_version='s3v4')
+        )
+
+    def _encryption(self):
+        if getattr(self, 'kms_key_id'):
+            return dict(ServerSideEncryption='aws:kms', SSEKMSKeyId=getattr(self, 'kms_key_id'))
+        return dict(ServerSideEncryption='AES256')
+
+    def _log_upload(self, dist_name):
         log.info('uploading {} to {} at {} using kms key {}'.format(
             dist_name,
             getattr(self, 's3_bucket'),
             getattr(self, 'endpoint_url') if len(getattr(self, 'endpoint_url')) else 'default endpoint',
             getattr(self, 'kms_key_id')
         ))
-        with open(dist_path, 'rb') as dist:
-            if getattr(self, 'kms_key_id'):
-                response = s3.put_object(
-                    Body=dist,
-                    Bucket=getattr(self, 's3_bucket'),
-                    Key=dist_name,
-                    ServerSideEncryption='aws:kms',
-                    SSEKMSKeyId=getattr(self, 'kms_key_id')
-                )
-            else:
-                response = s3.put_object(
-                    Body=dist,
-                    Bucket=getattr(self, 's3_bucket'),
-                    Key=dist_name,
-                    ServerSideEncryption='AES256'
-                )
-        setattr(self, 's3_object_key', dist_name)
-        setattr(self, 's3_object_version', response.get('VersionId'))
+
+    def _uploaded(self, dist_name, response, phase):
+        log.info('uploaded {} bytes of {} in {:.2f}s ({:.2f} MB/s)'.format(
+            phase['bytes'], dist_name, phase['seconds'], phase['bytes'] / max(phase['seconds'], 0.001) / 1024 / 1024
+        ))
         log.info('upload complete:\n{}'.format(
             json.dumps(response, sort_keys=True, indent=4, separators=(',', ': ')))
         )
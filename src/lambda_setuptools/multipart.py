@@ -0,0 +1,135 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from distutils import log
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUpload:
+    """An S3 multipart upload whose parts are sent concurrently as they are added.
+
+    At most twice max_concurrency parts are buffered at a time, and each part is
+    retried with exponential backoff before the whole upload is aborted.
+    """
+
+    def __init__(self, s3, bucket, key, max_concurrency=8, retries=3, **kwargs):
+        self._s3 = s3
+        self._bucket = bucket
+        self._key = key
+        self._retries = retries
+        self._upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **kwargs)[
+            "UploadId"
+        ]
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._slots = threading.BoundedSemaphore(max_concurrency * 2)
+        self._futures = []
+
+    def add_part(self, data):
+        """Queue the next part for upload, blocking while too many are in flight."""
+        self._slots.acquire()
+        future = self._executor.submit(self._upload_part, len(self._futures) + 1, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def complete(self):
+        """Wait for every part and complete the upload, aborting it on any failure."""
+        try:
+            parts = [future.result() for future in self._futures]
+            return self._s3.complete_multipart_upload(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                MultipartUpload=dict(Parts=parts),
+            )
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown()
+
+    def abort(self):
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown()
+        log.warn(f"aborting multipart upload of {self._key}")
+        self._s3.abort_multipart_upload(
+            Bucket=self._bucket, Key=self._key, UploadId=self._upload_id
+        )
+
+    def _upload_part(self, part_number, data):
+        attempt = 0
+        while True:
+            try:
+                response = self._s3.upload_part(
+                    Body=data,
+                    Bucket=self._bucket,
+                    Key=self._key,
+                    PartNumber=part_number,
+                    UploadId=self._upload_id,
+                )
+                return dict(ETag=response["ETag"], PartNumber=part_number)
+            except (BotoCoreError, ClientError) as err:
+                if attempt >= self._retries:
+                    raise
+                attempt += 1
+                log.warn(
+                    f"retrying part {part_number} of {self._key} (attempt {attempt}): {err}"
+                )
+                time.sleep(0.5 * 2**attempt)
+
+
+def upload_file(
+    s3, path, bucket, key, part_size, max_concurrency=8, retries=3, **kwargs
+):
+    """Upload a file with a concurrent multipart upload and return the completion response."""
+    upload = MultipartUpload(s3, bucket, key, max_concurrency, retries, **kwargs)
+    try:
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(part_size), b""):
+                upload.add_part(data)
+    except Exception:
+        upload.abort()
+        raise
+    return upload.complete()
+
+
+class MultipartUploadWriter:
+    """A write-only file object that sends everything written to it as a multipart upload.
+
+    Writes are buffered into part_size parts, so only the parts in flight are
+    held in memory. close() uploads the final part and completes the upload.
+    """
+
+    def __init__(self, upload, part_size):
+        self._upload = upload
+        self._part_size = part_size
+        self._buffer = bytearray()
+        self._position = 0
+        self._parts = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self._part_size:
+            self._upload.add_part(bytes(self._buffer[: self._part_size]))
+            del self._buffer[: self._part_size]
+            self._parts += 1
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer or not self._parts:
+            self._upload.add_part(bytes(self._buffer))
+            self._buffer = bytearray()
+        return self._upload.complete()
+
+    def abort(self):
+        self._upload.abort()
@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from distutils import log
+
+
+class Timings:
+    """Wall time and bytes handled by each phase of the ldist, lupload and lupdate commands.
+
+    One instance is shared by every command run for a distribution, so a report
+    written by lupdate also covers the ldist and lupload runs it triggered.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self._depth = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase. The yielded dict's "bytes" may be set by the caller."""
+        record = dict(name=name, start=time.time(), seconds=0.0, bytes=0)
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - started
+            with self._lock:
+                self.phases.append(record)
+
+    def summary(self):
+        lines = [f"{'phase':<40} {'seconds':>10} {'bytes':>14} {'MB/s':>10}"]
+        for record in sorted(self.phases, key=lambda r: r["start"]):
+            throughput = (
+                f"{record['bytes'] / record['seconds'] / 1024 / 1024:.2f}"
+                if record["bytes"] and record["seconds"]
+                else ""
+            )
+            lines.append(
+                f"{record['name']:<40} {record['seconds']:>10.3f} {record['bytes']:>14} {throughput:>10}"
+            )
+        return lines
+
+    def write(self, path, distribution):
+        with open(path, "w") as tf:
+            json.dump(
+                dict(
+                    name=distribution.get_name(),
+                    version=distribution.get_version(),
+                    phases=sorted(self.phases, key=lambda r: r["start"]),
+                ),
+                tf,
+                indent=2,
+            )
+        log.info(f"wrote timings to {path}")
+
+
+@contextmanager
+def command_timings(command):
+    """Time a command's run, logging a summary once the outermost command finishes.
+
+    The report is written to the command's timings-file option, if set.
+    """
+    timings = getattr(command.distribution, "lambda_timings", None)
+    if timings is None:
+        timings = Timings()
+        setattr(command.distribution, "lambda_timings", timings)
+    timings._depth += 1
+    try:
+        with timings.phase(type(command).__name__.lower()):
+            yield timings
+    finally:
+        timings._depth -= 1
+        if not timings._depth:
+            log.info("timings:")
+            for line in timings.summary():
+                log.info(line)
+        if getattr(command, "timings_file", None):
+            timings.write(getattr(command, "timings_file"), command.distribution)
@@ -0,0 +1,163 @@
+import ast
+import fnmatch
+import os
+from distutils import log
+
+EXTENSION_SUFFIXES = (".so", ".pyd")
+
+
+def find_modules(root):
+    """Map the dotted name of every module under root to its path and kind.
+
+    kind is "package", "module" or "extension". Files under directories that are
+    not valid identifiers, such as dist-info directories, are not modules.
+    """
+    modules = {}
+    for dirpath, _, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        parts = [] if reldir == "." else reldir.split(os.sep)
+        if not all(part.isidentifier() for part in parts):
+            continue
+        for filename in filenames:
+            name, _, suffix = filename.partition(".")
+            if not name.isidentifier():
+                continue
+            path = os.path.join(dirpath, filename)
+            if filename == "__init__.py":
+                if parts:
+                    modules[".".join(parts)] = (path, "package")
+            elif suffix == "py":
+                modules.setdefault(".".join(parts + [name]), (path, "module"))
+            elif filename.endswith(EXTENSION_SUFFIXES):
+                modules.setdefault(".".join(parts + [name]), (path, "extension"))
+    return modules
+
+
+def _resolve_name(name, level, package):
+    if not level:
+        return name
+    parts = package.split(".") if package else []
+    if level - 1 > len(parts):
+        return None
+    base = ".".join(parts[: len(parts) - (level - 1)])
+    return f"{base}.{name}" if name and base else name or base
+
+
+def find_imports(path, module, is_package):
+    """Return the names a module imports, statically.
+
+    Submodules named in "from" imports are included, and "pkg.*" stands for a
+    star import. Calls to importlib.import_module or __import__ with a constant
+    name count as imports.
+    """
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), path)
+    package = module if is_package else module.rpartition(".")[0]
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = _resolve_name(node.module, node.level, package)
+            if base is None:
+                continue
+            names.add(base)
+            names.update(
+                f"{base}.{alias.name}" if base else alias.name for alias in node.names
+            )
+        elif (
+            isinstance(node, ast.Call)
+            and (
+                isinstance(node.func, ast.Name)
+                and node.func.id in ("__import__", "import_module")
+                or isinstance(node.func, ast.Attribute)
+                and node.func.attr == "import_module"
+            )
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)
+        ):
+            name = node.args[0].value
+            level = len(name) - len(name.lstrip("."))
+            name = _resolve_name(name[level:], level, package)
+            if name:
+                names.add(name)
+    return names
+
+
+def reachable_modules(modules, roots):
+    """Return the names of the modules transitively imported by roots.
+
+    Importing a.b.c runs a and a.b as well. Extension modules and modules that
+    fail to parse cannot be analysed, so everything in their top level package
+    is treated as reachable.
+    """
+    reachable = set()
+    pending = list(roots)
+    while pending:
+        name = pending.pop()
+        if name.endswith(".*"):
+            base = name[:-2]
+            pending.append(base)
+            pending.extend(m for m in modules if m.rpartition(".")[0] == base)
+            continue
+        parts = name.split(".")
+        for i in range(1, len(parts) + 1):
+            candidate = ".".join(parts[:i])
+            if candidate in reachable or candidate not in modules:
+                continue
+            reachable.add(candidate)
+            path, kind = modules[candidate]
+            if kind != "extension":
+                try:
+                    pending.extend(find_imports(path, candidate, kind == "package"))
+                    continue
+                except (SyntaxError, ValueError) as err:
+                    log.warn(f"unable to analyse {path}, keeping {parts[0]}: {err}")
+            pending.extend(
+                m for m in modules if m == parts[0] or m.startswith(f"{parts[0]}.")
+            )
+    return reachable
+
+
+def unreachable_files(root, roots, keep=()):
+    """Return the paths under root, relative and "/" separated, that roots cannot reach.
+
+    Python modules are unreachable when nothing imports them. Other files belong
+    to their nearest enclosing package and are unreachable along with it, while
+    files outside any package (top level files, dist-info and the like) are kept.
+    Python files matching a keep glob are kept and analysed as further roots.
+    """
+    modules = find_modules(root)
+    module_paths = {path: name for name, (path, _) in modules.items()}
+    packages = {
+        os.path.dirname(path): name
+        for name, (path, kind) in modules.items()
+        if kind == "package"
+    }
+    roots = list(roots)
+    for path, name in module_paths.items():
+        relpath = os.path.relpath(path, root).replace(os.sep, "/")
+        if any(fnmatch.fnmatch(relpath, pattern) for pattern in keep):
+            roots.append(name)
+    reachable = reachable_modules(modules, roots)
+    unreachable = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, root).replace(os.sep, "/")
+            if any(fnmatch.fnmatch(relpath, pattern) for pattern in keep):
+                continue
+            name = module_paths.get(path)
+            if name is None or filename.endswith(EXTENSION_SUFFIXES):
+                # Shared objects may be loaded by other extensions, so they go
+                # with their package rather than on import analysis
+                package_dir = dirpath
+                while package_dir not in packages and package_dir != root:
+                    package_dir = os.path.dirname(package_dir)
+                name = packages.get(package_dir)
+                if name is None:
+                    continue
+            if name not in reachable:
+                unreachable.append(relpath)
+    return sorted(unreachable)